@@ -6,19 +6,39 @@ if you want to see the demo.
 """
 
 import os
+import sys
+import json
+import datetime
+import time
+import pickle
+import hashlib
 import logging
+import cProfile
+import multiprocessing
+
+import pandas
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 from gather_weather_data.husconet import GermanWinterTime
 
 from .filters import PROCESSED_DATA_DIR
 from .filters import StationRepository
+from .filters import SummaryFileIndex
 from .filters.preparation.average_husconet_radiation import average_solar_radiation_across_husconet_stations
 from .filters.preparation.average_husconet_temperature import average_temperature_across_husconet_stations
 from .filters.remove_wrongly_positioned_stations import filter_stations as filter_wrongly_positioned_stations
 from .filters.remove_extreme_values import filter_stations as filter_extreme_values
 from .filters.remove_infrequently_reporting_stations import filter_stations as filter_infrequently_reporting_stations
 from .filters.remove_indoor_stations import filter_stations as filter_indoor_stations
+from .filters.remove_indoor_stations import filter_stations_with_reference as filter_indoor_stations_with_reference
+from .filters.remove_indoor_stations import load_reference_data as load_indoor_reference_data
 from .filters.remove_unshaded_stations import filter_stations as filter_unshaded_stations
+from .filters.remove_unshaded_stations import filter_stations_with_reference as filter_unshaded_stations_with_reference
+from .filters.remove_unshaded_stations import load_reference_data as load_unshaded_reference_data
 
 
 def prepare():
@@ -67,6 +87,232 @@ def save_station_dicts_as_time_span_summary(station_dicts, output_dir=None):
         df.to_csv(csv_file)
 
 
+# the filter and its reference data, set once per worker process by ``_initialise_filter_worker``
+_worker_filter_function = None
+_worker_arguments = None
+_worker_returns_data_frames = False
+
+
+def _initialise_filter_worker(filter_function, arguments, load_reference_data, returns_data_frames):
+    global _worker_filter_function, _worker_arguments, _worker_returns_data_frames
+    _worker_filter_function = filter_function
+    _worker_arguments = arguments if load_reference_data is None else load_reference_data(*arguments)
+    _worker_returns_data_frames = returns_data_frames
+
+
+def _apply_filter_to_chunk_in_worker(station_dicts):
+    """
+    The station dicts do not need to be sent back, only the names of the stations which have been filtered out and,
+    for filters which modify the stations, the data frames.
+    """
+    filtered_station_names = {station_dict["name"] for station_dict in
+                              _worker_filter_function(station_dicts, *_worker_arguments)}
+    removed_station_names = [station_dict["name"] for station_dict in station_dicts
+                             if station_dict["name"] not in filtered_station_names]
+    data_frames = None
+    if _worker_returns_data_frames:
+        data_frames = [station_dict["data_frame"] for station_dict in station_dicts]
+    return removed_station_names, data_frames
+
+
+def apply_filter(filter_function, station_dicts, arguments=(), processes=1, load_reference_data=None,
+                 modifies_station_dicts=False):
+    """
+    Applies a filter to chunks of the station dicts in a worker pool. This works because all filters check each
+    station on its own, only the reference data is shared. Each worker loads it once when it is started.
+
+    :param filter_function: The ``filter_stations`` function of a filter module
+    :param station_dicts: The station dicts
+    :param arguments: The further arguments of the filter function or of ``load_reference_data``
+    :param processes: The number of worker processes, 1 applies the filter in this process and None uses one worker
+        per cpu
+    :param load_reference_data: If provided, it is called with the arguments once per process and returns the
+        further arguments of the filter function, e.g. ``remove_unshaded_stations.load_reference_data``
+    :param modifies_station_dicts: Whether the filter modifies the data frames, only then they are sent back
+    :return: The processed station dicts (some filters modify them) and the good stations, both in the given order
+    """
+    if processes == 1 or len(station_dicts) < 2:
+        if load_reference_data is not None:
+            arguments = load_reference_data(*arguments)
+        return station_dicts, filter_function(station_dicts, *arguments)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    # several chunks per worker so a slow chunk does not keep the others waiting
+    chunk_size = max(1, -(-len(station_dicts) // (processes * 4)))
+    chunks = [station_dicts[i:i + chunk_size] for i in range(0, len(station_dicts), chunk_size)]
+    initial_arguments = (filter_function, arguments, load_reference_data, modifies_station_dicts)
+    with multiprocessing.Pool(processes, _initialise_filter_worker, initial_arguments) as pool:
+        # map keeps the order of the chunks
+        results = pool.map(_apply_filter_to_chunk_in_worker, chunks, chunksize=1)
+    removed_station_names = set()
+    for chunk, (removed_chunk_station_names, data_frames) in zip(chunks, results):
+        removed_station_names.update(removed_chunk_station_names)
+        if data_frames is not None:
+            for station_dict, data_frame in zip(chunk, data_frames):
+                station_dict["data_frame"] = data_frame
+    filtered_station_dicts = [station_dict for station_dict in station_dicts
+                              if station_dict["name"] not in removed_station_names]
+    return station_dicts, filtered_station_dicts
+
+
+class StageCheckpoints:
+    """
+    Stores the result of each stage of the filtering pipe together with a key of everything the result depends on:
+    the key of the previous stage, the parameters and the source code of the filter module. A stage whose key has not
+    changed since the last run is loaded instead of being run again, so an interrupted run resumes after the last
+    completed stage and after a threshold has been changed only that filter and the following ones are rerun.
+    Changes of the reference data are not detected, in that case delete the checkpoint directory.
+    """
+
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = checkpoint_dir
+        if not os.path.isdir(checkpoint_dir):
+            os.mkdir(checkpoint_dir)
+
+    @staticmethod
+    def get_key(previous_key, stage_name, parameters, module_name=None):
+        """
+
+        :param previous_key: The key of the stage before or None for the first stage
+        :param stage_name: The name of the stage
+        :param parameters: The parameters of the stage, their string representation must be stable across runs
+        :param module_name: The module which implements the stage
+        :return: The key of the stage
+        """
+        key = hashlib.md5()
+        key.update(repr((previous_key, stage_name, [str(parameter) for parameter in parameters])).encode())
+        if module_name is not None:
+            with open(sys.modules[module_name].__file__, "rb") as f:
+                key.update(f.read())
+        return key.hexdigest()
+
+    def _get_files(self, stage_name):
+        prefix = os.path.join(self.checkpoint_dir, stage_name)
+        return prefix + ".pickle", prefix + ".key"
+
+    def load(self, stage_name, key):
+        """
+
+        :param stage_name: The name of the stage
+        :param key: The current key of the stage
+        :return: The stored station dicts or None if the stage has not been completed with this key
+        """
+        pickle_file, key_file = self._get_files(stage_name)
+        if not os.path.isfile(key_file) or not os.path.isfile(pickle_file):
+            return None
+        with open(key_file) as f:
+            if f.read() != key:
+                return None
+        logging.info("load checkpoint of stage " + stage_name)
+        with open(pickle_file, "rb") as f:
+            return pickle.load(f)
+
+    def save(self, stage_name, key, station_dicts):
+        """
+        The key is written last, so a stage only counts as completed once its result is complete.
+
+        :param stage_name: The name of the stage
+        :param key: The current key of the stage
+        :param station_dicts: The station dicts after this stage
+        """
+        pickle_file, key_file = self._get_files(stage_name)
+        if os.path.isfile(key_file):
+            os.remove(key_file)
+        temporary_file = pickle_file + "." + str(os.getpid()) + ".tmp"
+        with open(temporary_file, "wb") as f:
+            pickle.dump(station_dicts, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_file, pickle_file)
+        with open(key_file, "w") as f:
+            f.write(key)
+
+
+def count_rows(station_dicts):
+    if station_dicts is None:
+        return 0
+    return int(sum([station["data_frame"].temperature.count() for station in station_dicts]))
+
+
+def _get_resource_usage():
+    """
+
+    :return: The cpu time in s and the peak resident set size in MB of this process and of its terminated worker
+        processes
+    """
+    if resource is None:
+        return time.process_time(), None
+    own_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = own_usage.ru_utime + own_usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime
+    # kB on Linux, bytes on macOS
+    unit = 1024 ** 2 if sys.platform == "darwin" else 1024
+    peak_rss = max(own_usage.ru_maxrss, children_usage.ru_maxrss) / unit
+    return cpu_time, peak_rss
+
+
+class RunReport:
+    """
+    Records for each stage of the filtering pipe the wall time, the cpu time (including worker processes), the peak
+    resident set size, the rows processed and the stations removed. The peak resident set size is the high-water mark
+    of the run up to the end of the stage as the operating system does not reset it in between.
+    """
+
+    def __init__(self, profile_dir=None):
+        """
+
+        :param profile_dir: If provided, a cProfile dump of each stage is stored there (only this process)
+        """
+        self.stages = []
+        self.profile_dir = profile_dir
+        if profile_dir is not None and not os.path.isdir(profile_dir):
+            os.mkdir(profile_dir)
+
+    def measure(self, stage_name, run, station_dicts):
+        """
+
+        :param stage_name: The name of the stage
+        :param run: Runs the stage with the station dicts of the stage before and returns the good station dicts
+        :param station_dicts: The station dicts of the stage before
+        :return: The good station dicts
+        """
+        rows_before = count_rows(station_dicts)
+        profile = cProfile.Profile() if self.profile_dir is not None else None
+        cpu_time_before, _ = _get_resource_usage()
+        wall_time_before = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        new_station_dicts = run(station_dicts)
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(os.path.join(self.profile_dir, stage_name + ".prof"))
+        wall_time = time.perf_counter() - wall_time_before
+        cpu_time_after, peak_rss = _get_resource_usage()
+        stations_before = len(station_dicts) if station_dicts is not None else 0
+        stage = {
+            "stage": stage_name,
+            "wall_time": wall_time,
+            "cpu_time": cpu_time_after - cpu_time_before,
+            "peak_rss_mb": peak_rss,
+            "rows_processed": rows_before,
+            "rows_after": count_rows(new_station_dicts),
+            "stations_before": stations_before,
+            "stations_after": len(new_station_dicts),
+            "stations_removed": stations_before - len(new_station_dicts) if station_dicts is not None else 0
+        }
+        logging.info("stage {stage}: {wall_time:.1f}s wall time, {cpu_time:.1f}s cpu time".format(**stage))
+        self.stages.append(stage)
+        return new_station_dicts
+
+    def save(self, file_name_prefix):
+        """
+        Writes the report as '.json' and as '.csv' file.
+
+        :param file_name_prefix: The path without file ending
+        """
+        with open(file_name_prefix + ".json", "w") as f:
+            json.dump(self.stages, f, indent=2)
+        pandas.DataFrame(self.stages).to_csv(file_name_prefix + ".csv", index=False)
+
+
 def show_mini_statistics(old_station_dicts, new_station_dicts):
     old_stations = [station["name"] for station in old_station_dicts]
     new_stations = [station["name"] for station in new_station_dicts]
@@ -93,11 +339,12 @@ def show_mini_statistics(old_station_dicts, new_station_dicts):
 
 class FilterApplier:
 
-    def __init__(self, output_dir, force_overwrite, start_date, end_date):
+    def __init__(self, output_dir, force_overwrite, start_date, end_date, processes=1):
         self.output_dir = output_dir
         self.force_overwrite = force_overwrite
         self.start_date = start_date
         self.end_date = end_date
+        self.processes = processes
 
     def apply_extreme_record_filter(self, station_dicts, minimum_temperature):
         """
@@ -105,9 +352,10 @@ class FilterApplier:
 
         :param station_dicts: The station dicts
         :param minimum_temperature: Not below this temperature
-        :return: Good stations
+        :return: The station dicts without the extreme values
         """
-        filter_extreme_values(station_dicts, minimum_temperature)
+        station_dicts, _ = apply_filter(filter_extreme_values, station_dicts, [minimum_temperature], self.processes,
+                                        modifies_station_dicts=True)
         if self.force_overwrite:
             output_dir_for_summaries = os.path.join(
                 PROCESSED_DATA_DIR,
@@ -124,7 +372,8 @@ class FilterApplier:
         :param meta_info_df: The meta info.
         :return: Good stations
         """
-        with_valid_position_station_dicts = filter_wrongly_positioned_stations(station_dicts, meta_info_df)
+        _, with_valid_position_station_dicts = apply_filter(filter_wrongly_positioned_stations, station_dicts,
+                                                            [meta_info_df], self.processes)
         csv_path_with_valid_position = os.path.join(
             self.output_dir,
             "station_dicts_with_valid_position.csv"
@@ -144,7 +393,8 @@ class FilterApplier:
             self.output_dir,
             "station_dicts_frequent.csv"
         )
-        frequent_station_dicts = filter_infrequently_reporting_stations(station_dicts)
+        _, frequent_station_dicts = apply_filter(filter_infrequently_reporting_stations, station_dicts, [],
+                                                 self.processes, modifies_station_dicts=True)
         if not os.path.isfile(csv_path_frequent) or self.force_overwrite:
             save_station_dicts_as_metadata_csv(frequent_station_dicts, csv_path_frequent)
         if self.force_overwrite:
@@ -166,7 +416,9 @@ class FilterApplier:
             self.output_dir,
             "station_dicts_outdoor.csv"
         )
-        outdoor_station_dicts = filter_indoor_stations(station_dicts, self.start_date, self.end_date)
+        _, outdoor_station_dicts = apply_filter(filter_indoor_stations_with_reference, station_dicts,
+                                                [self.start_date, self.end_date], self.processes,
+                                                load_indoor_reference_data)
         if not os.path.isfile(csv_path_not_indoor) or self.force_overwrite:
             save_station_dicts_as_metadata_csv(outdoor_station_dicts, csv_path_not_indoor)
         return outdoor_station_dicts
@@ -182,7 +434,9 @@ class FilterApplier:
             self.output_dir,
             "station_dicts_shaded.csv"
         )
-        shaded_station_dicts = filter_unshaded_stations(station_dicts, self.start_date, self.end_date)
+        _, shaded_station_dicts = apply_filter(filter_unshaded_stations_with_reference, station_dicts,
+                                               [self.start_date, self.end_date], self.processes,
+                                               load_unshaded_reference_data, modifies_station_dicts=True)
         if not os.path.isfile(csv_path_shaded) or self.force_overwrite:
             save_station_dicts_as_metadata_csv(shaded_station_dicts, csv_path_shaded)
         if self.force_overwrite:
@@ -209,8 +463,90 @@ def save_filtered_out_stations(name, stations):
         f.write("\n".join([station for station in stations]))
 
 
+def _get_time_zone_key(time_zone):
+    """
+
+    :param time_zone: The time zone, e.g. 'CET' or GermanWinterTime() or None
+    :type time_zone: datetime.tzinfo | str | None
+    :return: An identifier of the time zone which is the same in every run
+    :rtype: str
+    """
+    if time_zone is None or isinstance(time_zone, str):
+        return repr(time_zone)
+    if type(time_zone).__repr__ is object.__repr__:  # the default contains the memory address
+        return "{module}.{name}({offset})".format(module=type(time_zone).__module__,
+                                                  name=type(time_zone).__qualname__,
+                                                  offset=time_zone.utcoffset(datetime.datetime(2016, 1, 1)))
+    return repr(time_zone)
+
+
+def get_start_parameters(station_repository, private_weather_stations_file_name, start_date, end_date, time_zone):
+    """
+    Everything the loaded stations depend on, including the size and modification time of each summary file, so
+    that regenerated summaries invalidate the start stage and all following ones.
+
+    :return: The parameters of the start stage
+    """
+    summary_files = hashlib.md5()
+    summary_file_index = SummaryFileIndex.for_directory(station_repository.summary_dir)
+    for station in station_repository.get_all_stations().index:
+        for file_name in summary_file_index.get_file_names(station):
+            file_stat = os.stat(os.path.join(station_repository.summary_dir, file_name))
+            summary_files.update("{file_name}:{size}:{mtime}|".format(
+                file_name=file_name, size=file_stat.st_size, mtime=file_stat.st_mtime_ns).encode())
+    return [private_weather_stations_file_name, os.path.getmtime(station_repository._get_stations_csv_file()),
+            station_repository.summary_dir, summary_files.hexdigest(), start_date, end_date,
+            _get_time_zone_key(time_zone)]
+
+
+def run_stage(checkpoints, previous_key, stage_name, parameters, module_name, run, station_dicts, report=None):
+    """
+
+    :param checkpoints: The checkpoints or None if every stage should be run
+    :type checkpoints: StageCheckpoints
+    :param previous_key: The key of the stage before
+    :param stage_name: The name of the stage
+    :param parameters: The parameters of the stage
+    :param module_name: The module which implements the stage
+    :param run: Runs the stage with the station dicts of the stage before and returns the good station dicts
+    :param station_dicts: The station dicts of the stage before
+    :param report: If provided, the stage is measured for this report
+    :type report: RunReport
+    :return: The key of this stage and the good station dicts
+    """
+    key = None
+    run_or_load = run
+    if checkpoints is not None:
+        key = checkpoints.get_key(previous_key, stage_name, parameters, module_name)
+
+        def run_or_load(dicts):
+            new_dicts = checkpoints.load(stage_name, key)
+            if new_dicts is None:
+                new_dicts = run(dicts)
+                checkpoints.save(stage_name, key, new_dicts)
+            return new_dicts
+
+    if report is None:
+        return key, run_or_load(station_dicts)
+    return key, report.measure(stage_name, run_or_load, station_dicts)
+
+
 def run_pipe(private_weather_stations_file_name, start_date, end_date, time_zone, minimum_temperature,
-             force_overwrite=False):
+             force_overwrite=False, processes=1, checkpoint_dir=None, profile_dir=None):
+    """
+
+    :param private_weather_stations_file_name: The station list
+    :param start_date: The first day to filter
+    :param end_date: The last day to filter (included)
+    :param time_zone: The time zone to load the stations in
+    :param minimum_temperature: Not below this temperature
+    :param force_overwrite: Overwrite existing result files
+    :param processes: The number of worker processes applying the filters, 1 applies them in this process and None
+        uses one worker per cpu
+    :param checkpoint_dir: If provided, the result of each stage is stored there and reused by later runs as long
+        as the stage and the stages before are unchanged, see ``StageCheckpoints``
+    :param profile_dir: If provided, a cProfile dump of each stage is stored there
+    """
 
     output_dir = os.path.join(
         PROCESSED_DATA_DIR,
@@ -221,44 +557,69 @@ def run_pipe(private_weather_stations_file_name, start_date, end_date, time_zone
 
     prepare()
 
+    checkpoints = StageCheckpoints(checkpoint_dir) if checkpoint_dir is not None else None
+    report = RunReport(profile_dir)
     station_repository = StationRepository(private_weather_stations_file_name)
-    station_dicts = station_repository.load_all_stations(start_date, end_date, time_zone)
     meta_info_df = station_repository.get_all_stations()
 
-    filter_applier = FilterApplier(output_dir, force_overwrite, start_date, end_date)
+    filter_applier = FilterApplier(output_dir, force_overwrite, start_date, end_date, processes)
 
     # START
+    start_parameters = []
+    if checkpoints is not None:
+        start_parameters = get_start_parameters(station_repository, private_weather_stations_file_name, start_date,
+                                                end_date, time_zone)
+    key, station_dicts = run_stage(
+        checkpoints, None, "start", start_parameters, None, lambda _: station_repository.load_all_stations(start_date, end_date, time_zone), None, report
+    )
     logging.debug("position - empty")
     no_rows_start = sum([station["data_frame"].temperature.count() for station in station_dicts])
     logging.info("# start: " + str(no_rows_start))
 
     # EXTREME
-    filter_applier.apply_extreme_record_filter(station_dicts, minimum_temperature)
+    key, station_dicts = run_stage(
+        checkpoints, key, "extreme", [minimum_temperature], filter_extreme_values.__module__,
+        lambda dicts: filter_applier.apply_extreme_record_filter(dicts, minimum_temperature), station_dicts, report
+    )
 
     # POSITION
-    with_valid_position_station_dicts = filter_applier.apply_invalid_position_filter(station_dicts, meta_info_df)
+    key, with_valid_position_station_dicts = run_stage(
+        checkpoints, key, "position", [], filter_wrongly_positioned_stations.__module__,
+        lambda dicts: filter_applier.apply_invalid_position_filter(dicts, meta_info_df), station_dicts, report
+    )
     logging.debug("position - empty")
     filtered_stations = show_mini_statistics(station_dicts, with_valid_position_station_dicts)
     save_filtered_out_stations("wrong_position", filtered_stations)
 
     # INFREQUENT
-    frequent_station_dicts = filter_applier.apply_infrequent_record_filter(with_valid_position_station_dicts)
+    key, frequent_station_dicts = run_stage(
+        checkpoints, key, "infrequent", [], filter_infrequently_reporting_stations.__module__,
+        filter_applier.apply_infrequent_record_filter, with_valid_position_station_dicts, report
+    )
     logging.debug("position - infrequent")
     filtered_stations = show_mini_statistics(with_valid_position_station_dicts, frequent_station_dicts)
     save_filtered_out_stations("infrequent", filtered_stations)
 
     # INDOOR
-    indoor_station_dicts = filter_applier.apply_not_indoor_filter(frequent_station_dicts)
+    key, indoor_station_dicts = run_stage(
+        checkpoints, key, "indoor", [start_date, end_date], filter_indoor_stations.__module__,
+        filter_applier.apply_not_indoor_filter, frequent_station_dicts, report
+    )
     logging.debug("infrequent - indoor")
     filtered_stations = show_mini_statistics(frequent_station_dicts, indoor_station_dicts)
     save_filtered_out_stations("indoor", filtered_stations)
 
     # UNSHADED
-    shaded_station_dicts = filter_applier.apply_unshaded_filter(indoor_station_dicts)
+    key, shaded_station_dicts = run_stage(
+        checkpoints, key, "unshaded", [start_date, end_date], filter_unshaded_stations.__module__,
+        filter_applier.apply_unshaded_filter, indoor_station_dicts, report
+    )
     logging.debug("indoor - shaded")
     filtered_stations = show_mini_statistics(indoor_station_dicts, shaded_station_dicts)
     save_filtered_out_stations("unshaded", filtered_stations)
 
+    report.save(os.path.join(output_dir, "run_report"))
+
 
 def demo():
     start_date = "2016-01-01T00:00:00"
@@ -3,28 +3,425 @@ Group some common functionality like loading data frames.
 """
 
 import os
+import bisect
 import datetime
 import logging
+import threading
+import collections.abc
 
 import numpy
 import pandas
 import dateutil.parser
 
+from gather_weather_data.husconet import convert_utc_to_local_time
+from gather_weather_data.wunderground.summarize_raw_data import HEADER_FORMAT
 from .. import PROCESSED_DATA_DIR
 
 
+# mean earth radius in m
+EARTH_RADIUS = 6371008.8
+
+
+def get_haversine_distances(lats_a, lons_a, lats_b, lons_b):
+    """
+    Great circle distances between all positions a and all positions b.
+
+    :param lats_a: latitudes in degree
+    :param lons_a: longitudes in degree
+    :param lats_b: latitudes in degree
+    :param lons_b: longitudes in degree
+    :return: The distances in m as an array of shape (len(lats_a), len(lats_b))
+    :rtype: ``numpy.ndarray``
+    """
+    lats_a = numpy.radians(numpy.asarray(lats_a, dtype=numpy.float64))[:, numpy.newaxis]
+    lons_a = numpy.radians(numpy.asarray(lons_a, dtype=numpy.float64))[:, numpy.newaxis]
+    lats_b = numpy.radians(numpy.asarray(lats_b, dtype=numpy.float64))[numpy.newaxis, :]
+    lons_b = numpy.radians(numpy.asarray(lons_b, dtype=numpy.float64))[numpy.newaxis, :]
+    haversine = (numpy.sin((lats_b - lats_a) / 2) ** 2
+                 + numpy.cos(lats_a) * numpy.cos(lats_b) * numpy.sin((lons_b - lons_a) / 2) ** 2)
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(haversine, 1)))
+
+
+def _get_cache_file(csv_file):
+    """
+
+    :param csv_file: The summary csv file
+    :return: The path of the binary copy of the csv file
+    """
+    return os.path.join(os.path.dirname(csv_file), ".cache", os.path.basename(csv_file)[:-4] + ".npz")
+
+
+def _write_cache_file(cache_file, data_frame, source_mtime, complete=True):
+    """
+    Stores the index as int64 nanoseconds since epoch and each column as its own array. Text columns such as the
+    cloud cover of the airport summaries are stored as fixed width strings together with a mask of the missing values.
+
+    :param complete: Whether the data frame contains all columns of the csv file
+    :return: Whether the data frame could be cached (only numeric, boolean and text columns can be)
+    """
+    arrays = {}
+    for column in data_frame.columns:
+        values = data_frame[column].values
+        if values.dtype.kind in "biuf":
+            arrays["column_" + column] = values
+            continue
+        if values.dtype != object:
+            return False
+        is_null = pandas.isnull(values)
+        if not all(isinstance(value, str) for value in values[~is_null]):
+            return False
+        arrays["column_" + column] = numpy.where(is_null, "", values).astype(str)
+        arrays["null_" + column] = is_null
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    temporary_file = cache_file + "." + str(os.getpid()) + ".tmp.npz"
+    numpy.savez(
+        temporary_file,
+        datetime=data_frame.index.values.astype("datetime64[ns]").view(numpy.int64),
+        columns=numpy.array(data_frame.columns.tolist(), dtype=str),
+        source_mtime=numpy.array(source_mtime),
+        complete=numpy.array(complete),
+        **arrays
+    )
+    os.replace(temporary_file, cache_file)  # other processes never see a half written file
+    return True
+
+
+def _read_cache_column(cached, column):
+    """
+
+    :param cached: The opened binary copy
+    :param column: The column to read
+    :return: The values as ``pandas.read_csv`` returns them, text columns with NaN for missing values
+    """
+    values = cached["column_" + column]
+    if "null_" + column in cached.files:
+        values = values.astype(object)
+        values[cached["null_" + column]] = numpy.nan
+    return values
+
+
+def _normalize_index(data_frame):
+    """
+    The summary files are written with UTC offsets, so pandas parses a time zone aware index. Like the binary copy,
+    the data frame is indexed by naive UTC time afterwards.
+    """
+    if isinstance(data_frame.index, pandas.DatetimeIndex) and data_frame.index.tz is not None:
+        data_frame.index = data_frame.index.tz_convert("UTC").tz_localize(None)
+    return data_frame
+
+
+def read_summary_csv(csv_file, usecols=None, use_cache=True):
+    """
+    Reads a summary csv with a 'datetime' column like ``pandas.read_csv`` but keeps a binary copy next to it.
+    Parsing the dates of minute-wise csv files is slow, so as long as the csv file has not been modified since,
+    later calls load the binary copy instead.
+
+    :param csv_file: Path to the csv file
+    :param usecols: The columns to load including 'datetime', all columns if None
+    :param use_cache: Whether to read and write the binary copy
+    :return: The data frame indexed by 'datetime' in naive UTC time
+    :rtype: ``pandas.DataFrame``
+    """
+    if not use_cache:
+        return _normalize_index(
+            pandas.read_csv(csv_file, usecols=usecols, index_col="datetime", parse_dates=["datetime"])
+        )
+    cache_file = _get_cache_file(csv_file)
+    source_mtime = os.path.getmtime(csv_file)
+    requested_columns = None if usecols is None else [column for column in usecols if column != "datetime"]
+    cached_columns = None
+    if os.path.isfile(cache_file):
+        with numpy.load(cache_file) as cached:
+            if float(cached["source_mtime"]) == source_mtime:
+                cached_columns = cached["columns"].tolist()
+                complete = bool(cached["complete"]) if "complete" in cached.files else True
+                if requested_columns is None and complete:
+                    columns = cached_columns
+                elif requested_columns is not None and set(requested_columns) <= set(cached_columns):
+                    columns = requested_columns
+                else:
+                    columns = None
+                if columns is not None:
+                    index = pandas.DatetimeIndex(cached["datetime"].view("datetime64[ns]"), name="datetime")
+                    return pandas.DataFrame({column: _read_cache_column(cached, column) for column in columns},
+                                            index=index, columns=columns)
+
+    # parse only the requested columns, but keep those cached before
+    columns_to_read = None
+    if requested_columns is not None:
+        columns_to_read = list(requested_columns)
+        if cached_columns is not None:
+            columns_to_read += [column for column in cached_columns if column not in columns_to_read]
+        columns_to_read = ["datetime"] + columns_to_read
+    data_frame = pandas.read_csv(csv_file, usecols=columns_to_read, index_col="datetime", parse_dates=["datetime"])
+    data_frame = _normalize_index(data_frame)
+    if not _write_cache_file(cache_file, data_frame, source_mtime, complete=columns_to_read is None):
+        logging.debug("no binary copy for csv file: " + csv_file)
+    if requested_columns is not None:
+        data_frame = data_frame[requested_columns]
+    return data_frame
+
+
+class SummaryFileIndex:
+    """
+    Maps each station to the summary files of a directory, i.e. '<station>.csv' covering everything and
+    '<station>_<YYYYmmdd>_<YYYYmmdd>.csv' covering the days of the span. The index of a directory is built once and
+    rebuilt when files are added to or removed from the directory.
+    """
+
+    _indices = {}
+
+    def __init__(self, summary_dir):
+        """
+
+        :param summary_dir: The directory with the summary files
+        """
+        self.complete_files = {}
+        self.span_starts = {}
+        self.spans = {}
+        spans = {}
+        for file_name in os.listdir(summary_dir):
+            if not file_name.endswith(".csv"):
+                continue
+            file_name_parts = file_name[:-4].split("_")  # cut of '.csv'
+            if len(file_name_parts) == 1:
+                self.complete_files[file_name_parts[0]] = file_name
+            elif len(file_name_parts) == 3:
+                station, start_date_span_text, end_date_span_text = file_name_parts
+                try:
+                    start_date_span = datetime.datetime.strptime(start_date_span_text, "%Y%m%d")
+                    end_date_span = datetime.datetime.strptime(end_date_span_text, "%Y%m%d")
+                except ValueError:
+                    continue
+                end_date_span = end_date_span.replace(hour=23, minute=59)
+                spans.setdefault(station, []).append((start_date_span, end_date_span, file_name))
+        for station, station_spans in spans.items():
+            station_spans.sort()
+            self.spans[station] = station_spans
+            self.span_starts[station] = [start_date_span for start_date_span, _, _ in station_spans]
+
+    @classmethod
+    def for_directory(cls, summary_dir):
+        """
+
+        :param summary_dir: The directory with the summary files
+        :return: The up to date index of that directory
+        :rtype: SummaryFileIndex
+        """
+        key = os.path.realpath(summary_dir)
+        modification_time = os.path.getmtime(summary_dir)
+        if key not in cls._indices or cls._indices[key][0] != modification_time:
+            cls._indices[key] = (modification_time, cls(summary_dir))
+        return cls._indices[key][1]
+
+    def get_file_names(self, station):
+        """
+
+        :param station: The station to search for
+        :return: All summary files of the station
+        :rtype: list[str]
+        """
+        file_names = [file_name for _, _, file_name in self.spans.get(station, [])]
+        if station in self.complete_files:
+            file_names.insert(0, self.complete_files[station])
+        return file_names
+
+    def search(self, station, start_date=None, end_date=None):
+        """
+
+        :param station: The station to search for
+        :param start_date: The earliest day which must be included, None for any
+        :type start_date: datetime.datetime | None
+        :param end_date: The latest day which must be included, None for any
+        :type end_date: datetime.datetime | None
+        :return: The name of the file which covers the time span, the span starting latest is preferred
+        :rtype: str | None
+        """
+        if station in self.complete_files:
+            return self.complete_files[station]
+        if station not in self.spans:
+            return None
+        station_spans = self.spans[station]
+        if start_date is None:
+            number_of_candidates = len(station_spans)
+        else:
+            # the spans are compared in the time zone of the requested dates
+            start_date = start_date.replace(tzinfo=None)
+            number_of_candidates = bisect.bisect_right(self.span_starts[station], start_date)
+        if end_date is not None:
+            end_date = end_date.replace(tzinfo=None)
+        for start_date_span, end_date_span, file_name in reversed(station_spans[:number_of_candidates]):
+            if end_date is None or end_date_span >= end_date:
+                return file_name
+        return None
+
+
+class LazyStationDict(dict):
+    """
+    A station dict which provides the name and the meta data right away but loads its data frame on the first access
+    of 'data_frame'. If the station has no data in the time span, the data frame is empty. The data frame counts as a
+    key from the beginning, so iterating, ``len``, ``dict(station_dict)`` and ``{**station_dict}`` behave as for a
+    plain station dict. When pickled (e.g. to be sent to a worker process), the data frame is loaded and a plain dict
+    is sent.
+    """
+
+    def __init__(self, station_repository, name, meta_data, start_date, end_date, time_zone, limit_to_temperature):
+        """
+
+        :param station_repository: The repository to load the station from
+        :type station_repository: StationRepository
+        :param name: The station name
+        :param meta_data: The meta data as in a station dict
+        :param start_date: The earliest day which must be included
+        :param end_date: The latest day which must be included
+        :param time_zone: The time zone, see ``StationRepository.load_station``
+        :param limit_to_temperature: Only load the temperature column
+        """
+        super().__init__(name=name, meta_data=meta_data)
+        self._load_arguments = (station_repository, name, start_date, end_date, time_zone, limit_to_temperature)
+        self._lock = threading.Lock()
+        self._prefetcher = None
+        self._position = None
+
+    def __getitem__(self, key):
+        if key == "data_frame" and self._prefetcher is not None:
+            self._prefetcher.notify_access(self._position)
+        return dict.__getitem__(self, key)
+
+    def __missing__(self, key):
+        if key != "data_frame":
+            raise KeyError(key)
+        self.materialise()
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key == "data_frame" or dict.__contains__(self, key)
+
+    def __iter__(self):
+        yield from dict.__iter__(self)
+        if not self.is_materialised():
+            yield "data_frame"
+
+    def __len__(self):
+        return dict.__len__(self) + (0 if self.is_materialised() else 1)
+
+    def keys(self):
+        return collections.abc.KeysView(self)
+
+    def items(self):
+        return collections.abc.ItemsView(self)
+
+    def values(self):
+        return collections.abc.ValuesView(self)
+
+    def get(self, key, default=None):
+        if key == "data_frame":
+            return self[key]
+        return dict.get(self, key, default)
+
+    def copy(self):
+        return dict(self)
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+    def is_materialised(self):
+        return dict.__contains__(self, "data_frame")
+
+    def materialise(self):
+        """
+        Loads the data frame unless this has happened before, also safe to call from several threads.
+        """
+        with self._lock:
+            if self.is_materialised():
+                return
+            station_repository, name, start_date, end_date, time_zone, limit_to_temperature = self._load_arguments
+            station_dict = station_repository.load_station(name, start_date, end_date, time_zone,
+                                                           limit_to_temperature)
+            if station_dict is None:
+                if limit_to_temperature:
+                    columns = ["temperature"]
+                else:
+                    columns = station_repository.get_summary_columns(name, start_date, end_date)
+                data_frame = pandas.DataFrame({column: numpy.array([], dtype=numpy.float64) for column in columns},
+                                              index=pandas.DatetimeIndex([], name="datetime"), columns=columns)
+            else:
+                data_frame = station_dict["data_frame"]
+            dict.__setitem__(self, "data_frame", data_frame)
+
+
+class StationPrefetcher:
+    """
+    Loads the data frames of lazy station dicts in background threads in the order of the list, but at most window
+    stations ahead of the last station whose data frame has been accessed. The threads are daemon threads, so they
+    never keep the interpreter from exiting, and they end once all stations are loaded or ``stop`` has been called.
+    """
+
+    def __init__(self, station_dicts, threads, window):
+        """
+
+        :param station_dicts: The station dicts to load
+        :type station_dicts: list of LazyStationDict
+        :param threads: The number of background threads
+        :param window: How many stations are loaded ahead of the last accessed one
+        """
+        self.station_dicts = station_dicts
+        self.window = window
+        self._next_position = 0
+        self._last_accessed_position = -1
+        self._stopped = False
+        self._condition = threading.Condition()
+        for position, station_dict in enumerate(station_dicts):
+            station_dict._prefetcher = self
+            station_dict._position = position
+        self._threads = [threading.Thread(target=self._run, name="station-prefetcher-" + str(i), daemon=True)
+                         for i in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def notify_access(self, position):
+        with self._condition:
+            if position > self._last_accessed_position:
+                self._last_accessed_position = position
+                self._condition.notify_all()
+
+    def stop(self):
+        """
+        Stops loading further stations, loads which have already started are finished.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped and self._next_position < len(self.station_dicts) \
+                        and self._next_position > self._last_accessed_position + self.window:
+                    self._condition.wait()
+                if self._stopped or self._next_position >= len(self.station_dicts):
+                    return
+                position = self._next_position
+                self._next_position += 1
+            try:
+                self.station_dicts[position].materialise()
+            except Exception:
+                # the consumer gets the error itself when it accesses the station
+                logging.exception("prefetching failed for " + self.station_dicts[position]["name"])
+
+
 class StationRepository:
 
     summary_dir = os.path.join(PROCESSED_DATA_DIR, "station_summaries")
 
     stations_df = None
 
-    cached_os_list_dir = None
-
-    def __init__(self, private_weather_stations_file_name=None, summary_dir=None):
+    def __init__(self, private_weather_stations_file_name=None, summary_dir=None, use_cache=True):
         """
         
         :param private_weather_stations_file_name: Where to look up the station metadata
+        :param summary_dir: Where to look up the station summaries
+        :param use_cache: Whether to keep binary copies of the summaries, see ``read_summary_csv``
         """
         if isinstance(private_weather_stations_file_name, tuple):
             raise RuntimeError("need text-like object")
@@ -40,7 +437,8 @@ class StationRepository:
             )
         self.private_weather_stations_file_name = private_weather_stations_file_name
         self.summary_dir = summary_dir
-        self.cached_os_list_dir = os.listdir(self.summary_dir)
+        self.use_cache = use_cache
+        self.prefetchers = []
         logging.debug("pws file name: %s" % private_weather_stations_file_name)
         logging.debug("summary dir: %s" % summary_dir)
 
@@ -51,7 +449,7 @@ class StationRepository:
         :rtype: ``pandas.DataFrame``
         """
         if self.stations_df is None:
-            csv_file = os.path.join(PROCESSED_DATA_DIR, self.private_weather_stations_file_name)
+            csv_file = self._get_stations_csv_file()
             if not os.path.isfile(csv_file):
                 logging.warning("No such file: ", os.path.realpath(csv_file))
                 raise RuntimeError("No private weather station list found. Run 'list_private_weather_stations.py'")
@@ -62,6 +460,39 @@ class StationRepository:
             self.stations_df = self.stations_df.iloc[:limit]
         return self.stations_df
 
+    def _get_stations_csv_file(self):
+        return os.path.join(PROCESSED_DATA_DIR, self.private_weather_stations_file_name)
+
+    def get_distance_matrix(self):
+        """
+        The distances between all stations of the station list. They are computed once and stored next to the
+        station list until it is modified.
+
+        :return: The distances in m, indexed by station name in both directions
+        :rtype: ``pandas.DataFrame``
+        """
+        csv_file = self._get_stations_csv_file()
+        distances_file = os.path.splitext(csv_file)[0] + "_distances.npz"
+        source_mtime = os.path.getmtime(csv_file)
+        if os.path.isfile(distances_file):
+            with numpy.load(distances_file) as cached:
+                if float(cached["source_mtime"]) == source_mtime:
+                    station_names = pandas.Index(cached["station_names"].tolist(), name="station")
+                    return pandas.DataFrame(cached["distances"], index=station_names, columns=station_names)
+        stations_df = pandas.read_csv(csv_file, index_col="station")  # all stations, not only the loaded ones
+        distances = get_haversine_distances(stations_df.lat.values, stations_df.lon.values,
+                                            stations_df.lat.values, stations_df.lon.values)
+        temporary_file = distances_file + "." + str(os.getpid()) + ".tmp.npz"
+        numpy.savez(
+            temporary_file,
+            distances=distances,
+            station_names=numpy.array(stations_df.index.tolist(), dtype=str),
+            source_mtime=numpy.array(source_mtime)
+        )
+        os.replace(temporary_file, distances_file)
+        logging.debug("stored distance matrix: " + distances_file)
+        return pandas.DataFrame(distances, index=stations_df.index, columns=stations_df.index)
+
     def get_meta_info(self, station):
         """
 
@@ -84,18 +515,124 @@ class StationRepository:
         :param limit: Limit to k stations to load
         :return: 
         """
-        station_dicts = []
+        station_dicts = list(self._iterate_station_dicts(start_date, end_date, time_zone, limit,
+                                                         limit_to_temperature))
+        logging.debug("loaded station_dicts: " + str(len(station_dicts)))
+        return station_dicts
+
+    def load_all_stations_lazily(self, start_date=None, end_date=None, time_zone=None, limit=0,
+                                 limit_to_temperature=True, prefetch_threads=0, prefetch_window=8):
+        """
+        Works like ``load_all_stations`` but returns at once. The data frames are only loaded when they are accessed
+        for the first time, see ``LazyStationDict``. Stations without data in the time span are kept but get an
+        empty data frame.
+
+        :param limit_to_temperature: Only consider temperature - saves memory but drops interesting data
+        :param start_date: The earliest day which must be included (potentially earlier)
+        :type start_date: str | datetime.datetime | None
+        :param end_date: The latest day which must be included (potentially later)
+        :type end_date: str | datetime.datetime | None
+        :param time_zone: The time zone, e.g. 'CET' or GermanWinterTime() or None for naive datetime objects
+        :type time_zone: datetime.tzinfo | str | None
+        :param limit: Limit to k stations to load
+        :param prefetch_threads: If provided, that many background threads load the data frames in the order of the
+            list ahead of their first access, see ``StationPrefetcher``. Call ``stop_prefetching`` when the
+            remaining stations are not needed anymore.
+        :param prefetch_window: How many stations are loaded ahead of the last accessed one
+        :rtype: list of LazyStationDict
+        """
+        start_date, end_date = self._cast_date(start_date, end_date)
+        station_dicts = [
+            LazyStationDict(self, station_name, {"position": {"lat": lat, "lon": lon}}, start_date, end_date,
+                            time_zone, limit_to_temperature)
+            for station_name, lat, lon in self.get_all_stations(limit).itertuples()
+        ]
+        if prefetch_threads:
+            self.prefetchers.append(StationPrefetcher(station_dicts, prefetch_threads, prefetch_window))
+        return station_dicts
+
+    def stop_prefetching(self):
+        """
+        Stops the background loading started by ``load_all_stations_lazily``.
+        """
+        for prefetcher in self.prefetchers:
+            prefetcher.stop()
+        self.prefetchers = []
+
+    def get_summary_columns(self, station, start_date, end_date):
+        """
+
+        :return: The columns (without 'datetime') of the summary file of the station or of a newly created summary
+            file if there is none
+        :rtype: list[str]
+        """
+        summary_file_name = self._search_summary_file(station, start_date, end_date)
+        if summary_file_name is None:
+            return HEADER_FORMAT.replace("{", "").replace("}", "").split(",")[1:]
+        csv_file = os.path.join(self.summary_dir, summary_file_name)
+        return [column for column in pandas.read_csv(csv_file, nrows=0).columns if column != "datetime"]
+
+    def load_all_stations_as_matrix(self, start_date=None, end_date=None, time_zone=None, limit=0):
+        """
+        Loads the temperature of all stations into one dense matrix instead of one data frame per station.
+        Only a single station data frame is held in memory at once while the matrix is filled.
+
+        :param start_date: The earliest day which must be included (potentially earlier)
+        :type start_date: str | datetime.datetime | None
+        :param end_date: The latest day which must be included (potentially later)
+        :type end_date: str | datetime.datetime | None
+        :param time_zone: The time zone, e.g. 'CET' or GermanWinterTime() or None for naive datetime objects
+        :type time_zone: datetime.tzinfo | str | None
+        :param limit: Limit to k stations to load
+        :return: The temperatures of all stations with data in the given time span
+        :rtype: StationMatrix
+        """
+        start_date, end_date = self._cast_date(start_date, end_date)
+        if start_date is None or end_date is None:
+            # the span can only be determined after every station has been read
+            station_dicts = self.load_all_stations(start_date, end_date, time_zone, limit)
+            if not station_dicts:
+                return StationMatrix.from_station_dicts(station_dicts, pandas.DatetimeIndex([], name="datetime"))
+            if start_date is None:
+                start_date = min(station_dict["data_frame"].index[0] for station_dict in station_dicts)
+            if end_date is None:
+                end_date = max(station_dict["data_frame"].index[-1] for station_dict in station_dicts)
+            else:
+                end_date = end_date + datetime.timedelta(days=1) - datetime.timedelta(minutes=1)
+            index = pandas.date_range(start_date, end_date, freq="T", name="datetime")
+            return StationMatrix.from_station_dicts(station_dicts, index)
+
+        index = pandas.date_range(
+            start_date,
+            end_date + datetime.timedelta(days=1) - datetime.timedelta(minutes=1),
+            freq="T",
+            name="datetime"
+        )
+        values = numpy.full((len(index), len(self.get_all_stations(limit))), numpy.nan, dtype=numpy.float32)
+        station_names = []
+        positions = []
+        for station_dict in self._iterate_station_dicts(start_date, end_date, time_zone, limit, True):
+            StationMatrix.fill_column(values[:, len(station_names)], index, station_dict["data_frame"])
+            station_names.append(station_dict["name"])
+            position = station_dict["meta_data"]["position"]
+            positions.append((position["lat"], position["lon"]))
+        values = numpy.ascontiguousarray(values[:, :len(station_names)])
+        logging.debug("loaded station matrix: " + str(values.shape))
+        return StationMatrix(index, station_names, values, positions)
+
+    def _iterate_station_dicts(self, start_date, end_date, time_zone, limit, limit_to_temperature):
+        """
+        Loads one station after another and removes those without data from the stations data frame afterwards.
+        """
         logging.debug("using summary dir: " + self.summary_dir)
         for station_name, lat, lon in self.get_all_stations(limit).itertuples():
             station_dict = self.load_station(station_name, start_date, end_date, time_zone, limit_to_temperature)
             if station_dict is not None:
-                station_dicts.append(station_dict)
                 logging.debug("load " + station_name)
+                yield station_dict
             else:
                 self.stations_df.lat.loc[station_name] = numpy.nan  # mark the station to be removed
         self.stations_df = self.stations_df[self.stations_df.lat.notnull()]  # remove stations which no data
-        logging.debug("loaded station_dicts: " + str(len(station_dicts)))
-        return station_dicts
 
     def load_station(self, station, start_date, end_date, time_zone=None, limit_to_temperature=True):
         """
@@ -125,17 +662,12 @@ class StationRepository:
             usecols = ["datetime", "temperature"]
         else:
             usecols = None  # that is the default value in the function declaration
-        station_df = pandas.read_csv(
-            csv_file,
-            usecols=usecols,
-            index_col="datetime",
-            parse_dates=["datetime"]
-        )
+        station_df = read_summary_csv(csv_file, usecols, self.use_cache)
         if station_df.empty or station_df.temperature.count() == 0:
             logging.debug("Not enough data for '{station}' at all".format(station=station))
             return None
         if time_zone is not None:
-            station_df = station_df.tz_localize("UTC").tz_convert(time_zone).tz_localize(None)
+            station_df = convert_utc_to_local_time(station_df, time_zone)
         if not station_df.index.is_monotonic:  # Some JSONs are damaged, so we need to sort them again
             station_df.sort_index(inplace=True)
         if start_date is not None:
@@ -184,36 +716,211 @@ class StationRepository:
         return start_date, end_date
 
     def _search_summary_file(self, station, start_date, end_date):
-        searched_station_summary_file_name = None
-        for station_summary_file_name in self.cached_os_list_dir:
-            if not station_summary_file_name.endswith(".csv"):
-                continue
-            if not station_summary_file_name.startswith(station):
-                continue
-            station_summary_file_name = station_summary_file_name[:-4]  # cut of '.csv'
-            file_name_parts = station_summary_file_name.split("_")
-            if len(file_name_parts) == 1:
-                searched_station_summary_file_name = file_name_parts[0] + ".csv"
-                break
-            elif len(file_name_parts) == 3:
-                station_part, start_date_span_text, end_date_span_text = file_name_parts
-                if station_part != station:
-                    continue
-                if start_date is None and end_date is None:
-                    searched_station_summary_file_name = station_summary_file_name + ".csv"
-                    break
-                start_date_span = datetime.datetime.strptime(start_date_span_text, "%Y%m%d")
-                start_date_span = start_date_span.replace(tzinfo=start_date.tzinfo)
-                start_date_span = start_date_span.replace(hour=0, minute=0)
-                end_date_span = datetime.datetime.strptime(end_date_span_text, "%Y%m%d")
-                end_date_span = end_date_span.replace(tzinfo=end_date.tzinfo)
-                end_date_span = end_date_span.replace(hour=23, minute=59)
-                if start_date_span <= start_date and end_date_span >= end_date:
-                    searched_station_summary_file_name = station_summary_file_name + ".csv"
-                    break
-        return searched_station_summary_file_name
+        return SummaryFileIndex.for_directory(self.summary_dir).search(station, start_date, end_date)
 
     def _get_metadata(self, station):
         if self.stations_df is None:
             self.get_all_stations()
         return self.stations_df.loc[station]
+
+
+class StationMatrix:
+    """
+    The temperatures of several stations aligned on a shared per-minute index.
+
+    The values are stored time-major (minutes x stations) as float32 so that all temperatures at one time point are
+    a single contiguous row. Missing measurements are NaN.
+    """
+
+    def __init__(self, index, station_names, values, positions):
+        """
+
+        :param index: The shared time axis
+        :type index: ``pandas.DatetimeIndex``
+        :param station_names: The station names, one per column
+        :param values: The temperatures with the shape (len(index), len(station_names))
+        :type values: ``numpy.ndarray``
+        :param positions: The (lat, lon) pairs, one per column
+        """
+        self.index = index
+        self.station_names = pandas.Index(station_names, name="station")
+        self.values = values
+        self.positions = numpy.array(positions, dtype=numpy.float64).reshape(len(self.station_names), 2)
+        self._availability_bitmasks = None
+
+    @staticmethod
+    def fill_column(column, index, station_df):
+        """
+        Writes the temperatures of a station data frame into the column at the matching minutes.
+
+        :param column: A view on the column to fill
+        :param index: The shared time axis
+        :param station_df: The station data frame with a temperature column
+        """
+        row_positions = index.get_indexer(station_df.index)
+        found = row_positions != -1
+        column[row_positions[found]] = station_df.temperature.values[found]
+
+    @classmethod
+    def from_station_dicts(cls, station_dicts, index, values=None):
+        """
+
+        :param station_dicts: The station dicts as returned by ``StationRepository.load_all_stations``
+        :param index: The shared time axis
+        :type index: ``pandas.DatetimeIndex``
+        :param values: A preallocated array of shape (len(index), len(station_dicts)), e.g. a memory map
+        :rtype: StationMatrix
+        """
+        if values is None:
+            values = numpy.empty((len(index), len(station_dicts)), dtype=numpy.float32)
+        values[:] = numpy.nan
+        positions = []
+        for j, station_dict in enumerate(station_dicts):
+            cls.fill_column(values[:, j], index, station_dict["data_frame"])
+            position = station_dict["meta_data"]["position"]
+            positions.append((position["lat"], position["lon"]))
+        return cls(index, [station_dict["name"] for station_dict in station_dicts], values, positions)
+
+    def save(self, file_name_prefix):
+        """
+        Stores the values as '.npy' file which can be memory mapped and the axes as '.npz' file. The axes are written
+        last, so a matrix is only found by ``load`` once it is complete.
+
+        :param file_name_prefix: The path without file ending
+        """
+        if isinstance(self.values, numpy.memmap) and self.values.filename is not None:
+            # the values have been written to disk already, e.g. by ``numpy.lib.format.open_memmap``
+            self.values.flush()
+            os.replace(self.values.filename, file_name_prefix + ".npy")
+        else:
+            temporary_values_file = file_name_prefix + "." + str(os.getpid()) + ".tmp.npy"
+            numpy.save(temporary_values_file, self.values)
+            os.replace(temporary_values_file, file_name_prefix + ".npy")
+        temporary_axes_file = file_name_prefix + "." + str(os.getpid()) + ".tmp.npz"
+        numpy.savez(
+            temporary_axes_file,
+            datetime=self.index.values.astype("datetime64[ns]").view(numpy.int64),
+            station_names=numpy.array(self.station_names.tolist(), dtype=str),
+            positions=self.positions
+        )
+        os.replace(temporary_axes_file, file_name_prefix + ".npz")
+
+    @classmethod
+    def load(cls, file_name_prefix, mmap_mode="r"):
+        """
+
+        :param file_name_prefix: The path without file ending as used for ``save``
+        :param mmap_mode: How to memory map the values, see ``numpy.load``. The default 'r' shares the pages read-only
+            between all processes which load the same file.
+        :return: The stored matrix or None if nothing has been stored yet
+        :rtype: StationMatrix | None
+        """
+        if not os.path.isfile(file_name_prefix + ".npz"):
+            return None
+        with numpy.load(file_name_prefix + ".npz") as axes:
+            index = pandas.DatetimeIndex(axes["datetime"].view("datetime64[ns]"), name="datetime")
+            station_names = axes["station_names"].tolist()
+            positions = axes["positions"]
+        values = numpy.load(file_name_prefix + ".npy", mmap_mode=mmap_mode)
+        return cls(index, station_names, values, positions)
+
+    def forward_fill(self, limit, columns=None):
+        """
+        Works like ``pandas.DataFrame.ffill(limit=limit)``, so a measurement stays valid for limit minutes.
+        The columns are processed in small blocks to keep the temporary arrays small.
+
+        :param limit: The maximum number of consecutive NaNs to fill
+        :param columns: The positions of the columns to fill, all if None
+        """
+        if columns is None:
+            columns = numpy.arange(len(self))
+        columns = numpy.asarray(columns, dtype=numpy.int64)
+        row_positions = numpy.arange(len(self.index))[:, numpy.newaxis]
+        block_size = 16
+        for block_start in range(0, len(columns), block_size):
+            block = columns[block_start:block_start + block_size]
+            block_values = self.values[:, block]
+            is_valid = ~numpy.isnan(block_values)
+            last_valid = numpy.where(is_valid, row_positions, -1)
+            numpy.maximum.accumulate(last_valid, axis=0, out=last_valid)
+            to_fill = ~is_valid & (last_valid >= 0) & (row_positions - last_valid <= limit)
+            block_values[to_fill] = block_values[last_valid[to_fill], numpy.nonzero(to_fill)[1]]
+            self.values[:, block] = block_values
+
+    def get_availability_bitmasks(self):
+        """
+        The stations with a measurement per time point, packed into bits. The bitmasks are computed once in row
+        blocks and then kept, so every finder working on this matrix shares them.
+
+        :return: An array of shape (len(index), ceil(len(station_names) / 8))
+        :rtype: ``numpy.ndarray``
+        """
+        if self._availability_bitmasks is None:
+            bitmasks = numpy.empty((len(self.index), (len(self) + 7) // 8), dtype=numpy.uint8)
+            block_size = 2 ** 16
+            for block_start in range(0, len(self.index), block_size):
+                block_values = self.values[block_start:block_start + block_size]
+                bitmasks[block_start:block_start + block_size] = numpy.packbits(~numpy.isnan(block_values), axis=1)
+            self._availability_bitmasks = bitmasks
+        return self._availability_bitmasks
+
+    def __len__(self):
+        return len(self.station_names)
+
+    def get_row_position(self, date):
+        """
+
+        :param date: The time point (pandas compatible)
+        :return: The row of the time point
+        :rtype: int
+        """
+        return self.index.get_loc(pandas.Timestamp(date))
+
+    def get_column_position(self, station):
+        """
+
+        :param station: The station name
+        :return: The column of the station
+        :rtype: int
+        """
+        return self.station_names.get_loc(station)
+
+    def at(self, date):
+        """
+
+        :param date: The time point (pandas compatible)
+        :return: The temperatures of all stations at that time point, NaN for unavailable stations
+        :rtype: ``numpy.ndarray``
+        """
+        return self.values[self.get_row_position(date)]
+
+    def get_station_series(self, station):
+        """
+
+        :param station: The station name
+        :return: The temperature of that station over time
+        :rtype: ``pandas.Series``
+        """
+        return pandas.Series(self.values[:, self.get_column_position(station)], index=self.index,
+                             name="temperature")
+
+    def as_station_dicts(self):
+        """
+        Provides the station dicts for code which is not yet working on the matrix.
+
+        :return: The station dicts as returned by ``StationRepository.load_all_stations``
+        """
+        station_dicts = []
+        for j, station in enumerate(self.station_names):
+            lat, lon = self.positions[j]
+            station_dicts.append({
+                "name": station,
+                "data_frame": pandas.DataFrame({"temperature": self.values[:, j]}, index=self.index),
+                "meta_data": {
+                    "position": {
+                        "lat": lat,
+                        "lon": lon
+                    }
+                }
+            })
+        return station_dicts
@@ -0,0 +1,65 @@
+"""
+
+Checks that the binary copies of the station summaries do not change what is loaded.
+For some stations the data frames are loaded straight from the csv files, from a fresh binary copy (cache miss) and
+from the existing binary copy (cache hit). All three must be identical.
+"""
+
+import os
+import logging
+
+import pandas
+
+from . import StationRepository
+from . import _get_cache_file
+from gather_weather_data.husconet import GermanWinterTime
+
+
+def check_station(station, start_date, end_date, time_zone, limit_to_temperature):
+    """
+
+    :param station: The station to load
+    :return: Whether the data frames of the cache miss and the cache hit equal the one read from the csv file
+    """
+    uncached_repository = StationRepository(use_cache=False)
+    cached_repository = StationRepository()
+    summary_file_name = cached_repository._search_summary_file(station, *cached_repository._cast_date(start_date,
+                                                                                                     end_date))
+    if summary_file_name is None:
+        logging.debug("no summary file for " + station)
+        return True
+    cache_file = _get_cache_file(os.path.join(cached_repository.summary_dir, summary_file_name))
+    if os.path.isfile(cache_file):
+        os.remove(cache_file)
+
+    expected_dict = uncached_repository.load_station(station, start_date, end_date, time_zone, limit_to_temperature)
+    for load in ("cache miss", "cache hit"):
+        station_dict = cached_repository.load_station(station, start_date, end_date, time_zone, limit_to_temperature)
+        if expected_dict is None or station_dict is None:
+            if expected_dict is not station_dict:
+                logging.error("{station}: only one of the loads found data ({load})".format(station=station, load=load))
+                return False
+            continue
+        try:
+            pandas.testing.assert_frame_equal(expected_dict["data_frame"], station_dict["data_frame"])
+        except AssertionError as error:
+            logging.error("{station}: {load} differs: {error}".format(station=station, load=load, error=error))
+            return False
+    return True
+
+
+def demo():
+    start_date = "2016-01-01T00:00:00"
+    end_date = "2016-12-31T00:00:00"
+    stations = ['IHAMBURG69', 'IBNNINGS2', 'IHAMBURG1795']
+    for time_zone in (None, GermanWinterTime(), "CET"):
+        for limit_to_temperature in (True, False):
+            for station in stations:
+                if not check_station(station, start_date, end_date, time_zone, limit_to_temperature):
+                    raise RuntimeError("The binary copy of '{station}' changes the loaded data".format(station=station))
+    print("cache miss and cache hit load the same data frames")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    demo()
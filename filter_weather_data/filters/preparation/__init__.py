@@ -0,0 +1,49 @@
+"""
+
+"""
+
+import os
+import logging
+
+import pandas
+
+from gather_weather_data.husconet import HUSCONET_STATIONS
+from gather_weather_data.husconet import PROCESSED_DATA_DIR
+
+
+def get_working_dir():
+    working_dir = os.path.join(PROCESSED_DATA_DIR, "husconet")
+    if not os.path.isdir(working_dir):
+        os.mkdir(working_dir)
+    return working_dir
+
+
+def get_stations_to_use(exclude_stations):
+    """
+
+    :param exclude_stations: collection of stations to exclude or None
+    :return: The remaining stations in the order of ``HUSCONET_STATIONS``
+    """
+    if exclude_stations is None:
+        return list(HUSCONET_STATIONS)
+    return [station for station in HUSCONET_STATIONS if station not in set(exclude_stations)]
+
+
+def load_husconet_matrix(column, stations):
+    """
+    Stacks one column of several husconet stations into one data frame aligned by time.
+
+    :param column: The column to load, e.g. 'temperature'
+    :param stations: The stations to load
+    :return: One column per station (time x station)
+    :rtype: ``pandas.DataFrame``
+    """
+    working_dir = get_working_dir()
+    station_series = []
+    for station in stations:
+        logging.debug(station)
+        csv_file = os.path.join(working_dir, station + ".csv")
+        station_df = pandas.read_csv(csv_file, usecols=[column, "datetime"], index_col="datetime",
+                                     parse_dates=["datetime"])
+        station_series.append(station_df[column].rename(station))
+    return pandas.concat(station_series, axis=1)
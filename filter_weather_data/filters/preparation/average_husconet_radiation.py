@@ -5,10 +5,9 @@ Average over all stations.
 import os
 import logging
 
-import pandas
-
-from gather_weather_data.husconet import HUSCONET_STATIONS
-from gather_weather_data.husconet import PROCESSED_DATA_DIR
+from . import get_working_dir
+from . import get_stations_to_use
+from . import load_husconet_matrix
 
 
 def average_solar_radiation_across_husconet_stations(force_overwrite=False, exclude_stations=None):
@@ -18,38 +17,43 @@ def average_solar_radiation_across_husconet_stations(force_overwrite=False, excl
     :param exclude_stations: collection of stations to exclude
     :param force_overwrite: Force to create new file
     """
+    average_solar_radiation_for_exclusion_sets([exclude_stations], force_overwrite)
+
+
+def average_solar_radiation_for_exclusion_sets(exclusion_sets, force_overwrite=False):
+    """
+    Works like ``average_solar_radiation_across_husconet_stations`` for several collections of stations to exclude
+    (e.g. for leave-one-out evaluation). Each station is loaded once and all averages are computed from the same
+    aligned data frame.
 
-    working_dir = os.path.join(PROCESSED_DATA_DIR, "husconet")
-    if not os.path.isdir(working_dir):
-        os.mkdir(working_dir)
-    if exclude_stations is None:
-        file_name = "husconet_average_radiation.csv"
-    else:
-        exclude_stations.sort()
-        file_name = "husconet_average_radiation_exclude_{excluded}.csv".format(excluded="_".join(exclude_stations))
-    csv_output = os.path.join(working_dir, file_name)
-    if os.path.isfile(csv_output) and not force_overwrite:
-        logging.debug("husconet average radiation file '{file}' already exists, skipping".format(file=file_name))
+    :param exclusion_sets: collections of stations to exclude, None stands for using all stations
+    :param force_overwrite: Force to create new files
+    """
+    working_dir = get_working_dir()
+    files_to_create = []
+    for exclude_stations in exclusion_sets:
+        if exclude_stations is None:
+            file_name = "husconet_average_radiation.csv"
+        else:
+            file_name = "husconet_average_radiation_exclude_{excluded}.csv".format(
+                excluded="_".join(sorted(exclude_stations)))
+        csv_output = os.path.join(working_dir, file_name)
+        if os.path.isfile(csv_output) and not force_overwrite:
+            logging.debug("husconet average radiation file '{file}' already exists, skipping".format(file=file_name))
+        else:
+            logging.debug("husconet average radiation file '{file}' needs to be generated".format(file=file_name))
+            files_to_create.append((csv_output, get_stations_to_use(exclude_stations)))
+    if not files_to_create:
         return
-    else:
-        logging.debug("husconet average radiation file '{file}' needs to be generated".format(file=file_name))
-
-    df = pandas.DataFrame()
-    if exclude_stations is None:
-        stations_to_use = HUSCONET_STATIONS
-    else:
-        stations_to_use = set(HUSCONET_STATIONS) - set(exclude_stations)
-    for station in stations_to_use:
-        logging.debug(station)
-        csv_file = os.path.join(working_dir, station + ".csv")
-        station_df = pandas.read_csv(csv_file, usecols=["radiation", "datetime"], index_col="datetime",
-                                     parse_dates=["datetime"])
-        df = df.join(station_df, how="outer", rsuffix="_" + station)
-    df = df.mean(axis=1).rename("radiation")
-    df.to_csv(csv_output, header=True)
+
+    stations_to_load = [station for station in get_stations_to_use(None)
+                        if any(station in stations_to_use for _, stations_to_use in files_to_create)]
+    station_df = load_husconet_matrix("radiation", stations_to_load)
+    for csv_output, stations_to_use in files_to_create:
+        df = station_df[stations_to_use]
+        df.mean(axis=1).rename("radiation").to_csv(csv_output, header=True)
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
-    average_solar_radiation_across_husconet_stations()
-    average_solar_radiation_across_husconet_stations(exclude_stations=["HCM"])
+    average_solar_radiation_for_exclusion_sets([None, ["HCM"]])
@@ -7,8 +7,9 @@ import logging
 
 import pandas
 
-from gather_weather_data.husconet import HUSCONET_STATIONS
-from gather_weather_data.husconet import PROCESSED_DATA_DIR
+from . import get_working_dir
+from . import get_stations_to_use
+from . import load_husconet_matrix
 
 
 def average_temperature_across_husconet_stations(force_overwrite=False, exclude_stations=None):
@@ -18,36 +19,44 @@ def average_temperature_across_husconet_stations(force_overwrite=False, exclude_
     :param exclude_stations: collection of stations to exclude
     :param force_overwrite: Force to create new file
     """
+    average_temperature_for_exclusion_sets([exclude_stations], force_overwrite)
 
-    working_dir = os.path.join(PROCESSED_DATA_DIR, "husconet")
-    if not os.path.isdir(working_dir):
-        os.mkdir(working_dir)
-    if exclude_stations is None:
-        file_name = "husconet_average_temperature.csv"
-    else:
-        file_name = "husconet_average_temperature_exclude_{excluded}.csv".format(excluded="_".join(exclude_stations))
-    csv_output = os.path.join(working_dir, file_name)
-    if os.path.isfile(csv_output) and not force_overwrite:
-        logging.debug("husconet average temperature file '{file}' already exists, skipping".format(file=file_name))
+
+def average_temperature_for_exclusion_sets(exclusion_sets, force_overwrite=False):
+    """
+    Works like ``average_temperature_across_husconet_stations`` for several collections of stations to exclude
+    (e.g. for leave-one-out evaluation). Each station is loaded once and all averages are computed from the same
+    aligned data frame.
+
+    :param exclusion_sets: collections of stations to exclude, None stands for using all stations
+    :param force_overwrite: Force to create new files
+    """
+    working_dir = get_working_dir()
+    files_to_create = []
+    for exclude_stations in exclusion_sets:
+        if exclude_stations is None:
+            file_name = "husconet_average_temperature.csv"
+        else:
+            file_name = "husconet_average_temperature_exclude_{excluded}.csv".format(
+                excluded="_".join(sorted(exclude_stations)))
+        csv_output = os.path.join(working_dir, file_name)
+        if os.path.isfile(csv_output) and not force_overwrite:
+            logging.debug("husconet average temperature file '{file}' already exists, skipping".format(file=file_name))
+        else:
+            logging.debug("husconet average temperature file '{file}' needs to be generated".format(file=file_name))
+            files_to_create.append((csv_output, get_stations_to_use(exclude_stations)))
+    if not files_to_create:
         return
-    else:
-        logging.debug("husconet average temperature file '{file}' needs to be generated".format(file=file_name))
-
-    if exclude_stations is None:
-        stations_to_use = HUSCONET_STATIONS
-    else:
-        stations_to_use = set(HUSCONET_STATIONS) - set(exclude_stations)
-    df = pandas.DataFrame()
-    for station in stations_to_use:
-        logging.debug(station)
-        csv_file = os.path.join(working_dir, station + ".csv")
-        station_df = pandas.read_csv(csv_file, usecols=["temperature", "datetime"], index_col="datetime",
-                                     parse_dates=["datetime"])
-        df = df.join(station_df, how="outer", rsuffix="_" + station)
-    average_temperature = df.mean(axis=1).rename("temperature")
-    standard_deviation_temperature = df.std(axis=1).rename("temperature_std")
-    df_2 = pandas.concat([average_temperature, standard_deviation_temperature], axis=1)
-    df_2.to_csv(csv_output, header=True)
+
+    stations_to_load = [station for station in get_stations_to_use(None)
+                        if any(station in stations_to_use for _, stations_to_use in files_to_create)]
+    station_df = load_husconet_matrix("temperature", stations_to_load)
+    for csv_output, stations_to_use in files_to_create:
+        df = station_df[stations_to_use]
+        average_temperature = df.mean(axis=1).rename("temperature")
+        standard_deviation_temperature = df.std(axis=1).rename("temperature_std")
+        df_2 = pandas.concat([average_temperature, standard_deviation_temperature], axis=1)
+        df_2.to_csv(csv_output, header=True)
 
 
 if __name__ == "__main__":
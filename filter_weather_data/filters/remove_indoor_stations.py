@@ -4,14 +4,14 @@ Run as script with '-m filter_weather_data.filters.remove_indoor_stations'
 """
 
 import logging
-import statistics
 
 import numpy
+import pandas
 
 from gather_weather_data.husconet import load_husconet_temperature_average
 from gather_weather_data.husconet import GermanWinterTime
 from . import StationRepository
-from .preparation.average_husconet_temperature import average_temperature_across_husconet_stations
+from .preparation.average_husconet_temperature import average_temperature_for_exclusion_sets
 
 
 class Ellipse:
@@ -65,6 +65,57 @@ class Ellipse:
         return inside_rectangle and inside_ellipse
 
 
+def are_inside_ellipses(ellipses, points_x, points_y):
+    """
+    Works like ``point in ellipse`` for many ellipses and points at once.
+
+    :param ellipses: The ellipses
+    :param points_x: The x values, the last axis must match the ellipses (e.g. stations x months)
+    :param points_y: The y values, the last axis must match the ellipses (e.g. stations x months)
+    :return: Whether each point is inside its ellipse
+    :rtype: ``numpy.ndarray``
+    """
+    center_x = numpy.array([ellipse.center_x for ellipse in ellipses], dtype=numpy.float64)
+    center_y = numpy.array([ellipse.center_y for ellipse in ellipses], dtype=numpy.float64)
+    radius_x_axis = numpy.array([ellipse.radius_x_axis for ellipse in ellipses], dtype=numpy.float64)
+    radius_y_axis = numpy.array([ellipse.radius_y_axis for ellipse in ellipses], dtype=numpy.float64)
+    points_x = numpy.asarray(points_x, dtype=numpy.float64)
+    points_y = numpy.asarray(points_y, dtype=numpy.float64)
+    inside_rectangle = (
+        (center_x - radius_x_axis <= points_x) & (points_x <= center_x + radius_x_axis)
+        &
+        (center_y - radius_y_axis <= points_y) & (points_y <= center_y + radius_y_axis)
+    )
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        inside_ellipse = (
+            ((points_x - center_x) ** 2 / radius_x_axis ** 2)
+            +
+            ((points_y - center_y) ** 2 / radius_y_axis ** 2)
+        ) <= 1
+    return inside_rectangle & inside_ellipse
+
+
+def get_daily_statistics(temperatures):
+    """
+    One aggregation over the index instead of a loop over all days.
+
+    :param temperatures: The temperature of one station (series) or of several stations (data frame)
+    :return: The daily minimum and standard deviation, only days with an entry in the index are included
+    """
+    days = temperatures.index.normalize()
+    grouped_by_day = temperatures.groupby(days)
+    return grouped_by_day.min(), grouped_by_day.std()
+
+
+def get_month_keys(index):
+    """
+
+    :param index: A datetime index
+    :return: The month keys as used for the reference interval, e.g. '2016-1'
+    """
+    return index.year.astype(str) + "-" + index.month.astype(str)
+
+
 def check_station(station_df, reference_interval):
     """
     
@@ -72,34 +123,54 @@ def check_station(station_df, reference_interval):
     :param reference_interval: Given a value pair (a, b) it says whether those two values are inside the interval
     :return: Is the station ok
     """
-    for year in station_df.index.year.unique():
-        year_key = "{year}".format(year=year)
-        year_df = station_df.loc[year_key:year_key]
-
-        for month in year_df.index.month.unique():
-            daily_minimum_temperatures_per_month = []
-            daily_standard_deviation_per_month = []
-            month_key = "{year}-{month}".format(year=year, month=month)
-            month_df = year_df.loc[month_key:month_key]
-            for day in month_df.index.day.unique():
-                day_key = "{year}-{month}-{day}".format(year=year, month=month, day=day)
-                day_df = station_df.loc[day_key:day_key]
-                t_min = day_df.temperature.min()
-                daily_minimum_temperatures_per_month.append(t_min)
-                t_std = day_df.temperature.std()
-                if numpy.isnan(t_std):
-                    logging.warning("No robust statistics possible, check frequent reporting!")
-                    raise RuntimeError("No robust statistics possible, check frequent reporting!")
-                else:
-                    daily_standard_deviation_per_month.append(t_std)
-            minimum_temperature_mean = statistics.mean(daily_minimum_temperatures_per_month)
-            temperature_standard_deviation = statistics.mean(daily_standard_deviation_per_month)
-            if (minimum_temperature_mean, temperature_standard_deviation) not in reference_interval[month_key]:
-                logging.debug(month_key)
-                return False
+    if station_df.empty:
+        return True
+    daily_minimum_temperatures, daily_standard_deviations = get_daily_statistics(station_df.temperature)
+    if daily_standard_deviations.isnull().any():
+        logging.warning("No robust statistics possible, check frequent reporting!")
+        raise RuntimeError("No robust statistics possible, check frequent reporting!")
+    month_keys = get_month_keys(daily_minimum_temperatures.index)
+    minimum_temperature_means = daily_minimum_temperatures.groupby(month_keys, sort=False).mean()
+    temperature_standard_deviations = daily_standard_deviations.groupby(month_keys, sort=False).mean()
+    is_inside = are_inside_ellipses(
+        [reference_interval[month_key] for month_key in minimum_temperature_means.index],
+        minimum_temperature_means.values,
+        temperature_standard_deviations.values
+    )
+    if not is_inside.all():
+        logging.debug(minimum_temperature_means.index[~is_inside][0])
+        return False
     return True
 
 
+def check_stations(station_matrix, reference_interval):
+    """
+    Works like ``check_station`` but for all stations of a matrix at once. Days on which a station did not report
+    are skipped for that station.
+
+    :param station_matrix: The stations to check
+    :type station_matrix: StationMatrix
+    :param reference_interval: Given a value pair (a, b) it says whether those two values are inside the interval
+    :return: Is each station ok
+    :rtype: ``numpy.ndarray``
+    """
+    temperatures = pandas.DataFrame(station_matrix.values, index=station_matrix.index)
+    daily_minimum_temperatures, daily_standard_deviations = get_daily_statistics(temperatures)
+    if (daily_minimum_temperatures.notnull() & daily_standard_deviations.isnull()).values.any():
+        logging.warning("No robust statistics possible, check frequent reporting!")
+        raise RuntimeError("No robust statistics possible, check frequent reporting!")
+    month_keys = get_month_keys(daily_minimum_temperatures.index)
+    minimum_temperature_means = daily_minimum_temperatures.groupby(month_keys, sort=False).mean()
+    temperature_standard_deviations = daily_standard_deviations.groupby(month_keys, sort=False).mean()
+    is_inside = are_inside_ellipses(
+        [reference_interval[month_key] for month_key in minimum_temperature_means.index],
+        minimum_temperature_means.values.T,  # stations x months
+        temperature_standard_deviations.values.T
+    )
+    has_data = minimum_temperature_means.notnull().values.T
+    return (is_inside | ~has_data).all(axis=1)
+
+
 def get_reference_interval(start_date, end_date, excluded_reference_stations):
     """
     
@@ -111,43 +182,36 @@ def get_reference_interval(start_date, end_date, excluded_reference_stations):
     reference_df = load_husconet_temperature_average(start_date, end_date, excluded_reference_stations)
     result = {}
 
-    for year in reference_df.index.year.unique():
-        year_key = str(year)
-        year_df = reference_df.loc[year_key:year_key]
-        for month in year_df.index.month.unique():
-            daily_minimum_temperatures_per_month = []
-            daily_standard_deviation_per_month = []
-            month_key = "{year}-{month}".format(year=year, month=month)
-            month_df = year_df.loc[month_key:month_key]
-            for day in month_df.index.day.unique():
-                day_key = "{year}-{month}-{day}".format(year=year, month=month, day=day)
-                day_df = month_df.loc[day_key:day_key]
-                t_min = day_df.temperature.min()
-                daily_minimum_temperatures_per_month.append(t_min)
-                t_std = day_df.temperature.std()
-                if not numpy.isnan(t_std):
-                    daily_standard_deviation_per_month.append(t_std)
-
-            minimum_temperature_mean = statistics.mean(daily_minimum_temperatures_per_month)
-            minimum_temperature_std = statistics.stdev(daily_minimum_temperatures_per_month)
-            daily_standard_deviation_mean = statistics.mean(daily_standard_deviation_per_month)
-            daily_standard_deviation_std = statistics.stdev(daily_standard_deviation_per_month)
-
-            logging.debug(month_key)
-            result[month_key] = Ellipse(
-                minimum_temperature_mean,
-                minimum_temperature_std * 5,
-                daily_standard_deviation_mean,
-                daily_standard_deviation_std * 5
-            )
-            logging.debug("minimum_temperature_mean {month_key}: {minimum_temperature_mean}"
-                          .format(month_key=month_key, minimum_temperature_mean=minimum_temperature_mean))
-            logging.debug("minimum_temperature_std * 5 {month_key}: {minimum_temperature_std5}"
-                          .format(month_key=month_key, minimum_temperature_std5=minimum_temperature_std * 5))
-            logging.debug("daily_standard_deviation_mean {month_key}: {daily_standard_deviation_mean}"
-                          .format(month_key=month_key, daily_standard_deviation_mean=daily_standard_deviation_mean))
-            logging.debug("daily_standard_deviation_std * 5 {month_key}: {daily_standard_deviation_std5}"
-                          .format(month_key=month_key, daily_standard_deviation_std5=daily_standard_deviation_std * 5))
+    daily_minimum_temperatures, daily_standard_deviations = get_daily_statistics(reference_df.temperature)
+    month_keys = get_month_keys(daily_minimum_temperatures.index)
+    grouped_minimum_temperatures = daily_minimum_temperatures.groupby(month_keys, sort=False)
+    grouped_standard_deviations = daily_standard_deviations.groupby(month_keys, sort=False)
+    minimum_temperature_means = grouped_minimum_temperatures.mean()
+    minimum_temperature_stds = grouped_minimum_temperatures.std()
+    daily_standard_deviation_means = grouped_standard_deviations.mean()
+    daily_standard_deviation_stds = grouped_standard_deviations.std()
+
+    for month_key in minimum_temperature_means.index:
+        minimum_temperature_mean = minimum_temperature_means[month_key]
+        minimum_temperature_std = minimum_temperature_stds[month_key]
+        daily_standard_deviation_mean = daily_standard_deviation_means[month_key]
+        daily_standard_deviation_std = daily_standard_deviation_stds[month_key]
+
+        logging.debug(month_key)
+        result[month_key] = Ellipse(
+            minimum_temperature_mean,
+            minimum_temperature_std * 5,
+            daily_standard_deviation_mean,
+            daily_standard_deviation_std * 5
+        )
+        logging.debug("minimum_temperature_mean {month_key}: {minimum_temperature_mean}"
+                      .format(month_key=month_key, minimum_temperature_mean=minimum_temperature_mean))
+        logging.debug("minimum_temperature_std * 5 {month_key}: {minimum_temperature_std5}"
+                      .format(month_key=month_key, minimum_temperature_std5=minimum_temperature_std * 5))
+        logging.debug("daily_standard_deviation_mean {month_key}: {daily_standard_deviation_mean}"
+                      .format(month_key=month_key, daily_standard_deviation_mean=daily_standard_deviation_mean))
+        logging.debug("daily_standard_deviation_std * 5 {month_key}: {daily_standard_deviation_std5}"
+                      .format(month_key=month_key, daily_standard_deviation_std5=daily_standard_deviation_std * 5))
     return result
 
 
@@ -159,9 +223,27 @@ def filter_stations(station_dicts, start_date, end_date, excluded_reference_stat
     :param end_date: The date to stop (included)
     :param excluded_reference_stations: Exclude a collection of reference stations (e.g. for future evaluation)
     """
-    reference_interval = get_reference_interval(start_date, end_date, excluded_reference_stations)
-    filtered_stations = []
+    return filter_stations_with_reference(station_dicts, *load_reference_data(start_date, end_date,
+                                                                            excluded_reference_stations))
+
 
+def load_reference_data(start_date, end_date, excluded_reference_stations=None):
+    """
+    Computes the reference once so that it can be shared by several calls of ``filter_stations_with_reference``.
+
+    :return: The arguments for ``filter_stations_with_reference``
+    """
+    return get_reference_interval(start_date, end_date, excluded_reference_stations),
+
+
+def filter_stations_with_reference(station_dicts, reference_interval):
+    """
+    Works like ``filter_stations`` with the reference computed by ``load_reference_data``.
+
+    :param station_dicts: The station dicts
+    :param reference_interval: See ``get_reference_interval``
+    """
+    filtered_stations = []
     for station_dict in station_dicts:
         logging.debug("indoor " + station_dict["name"])
         if check_station(station_dict["data_frame"], reference_interval):
@@ -178,12 +260,12 @@ def demo():
     station_dicts = [station_repository.load_station(station, start_date, end_date, time_zone=time_zone)
                      for station in stations]
     station_dicts = [s for s in station_dicts if s]
+    exclude_hcm = ["HCM"]
+    average_temperature_for_exclusion_sets([None, exclude_hcm])
     print("use all reference stations")
     stations_inside_reference = filter_stations(station_dicts, start_date, end_date)
     print([station_dict["name"] for station_dict in stations_inside_reference])
     print()
-    exclude_hcm = ["HCM"]
-    average_temperature_across_husconet_stations(exclude_stations=exclude_hcm)
     print("use some reference stations")
     stations_inside_reference = filter_stations(station_dicts, start_date, end_date,
                                                 excluded_reference_stations=exclude_hcm)
@@ -8,6 +8,7 @@ import logging
 import calendar
 
 import numpy
+import pandas
 
 from gather_weather_data.husconet import GermanWinterTime
 from . import StationRepository
@@ -18,38 +19,52 @@ def check_station(station_dict):
     Be aware that start and end date are not time zone sensitive when provided as a string, see
     https://github.com/pandas-dev/pandas/issues/16785
     
-    This function modifies the handed in station_df
+    This function replaces the data frame of the handed in station dict, days with too few reports are removed
 
     :param station_dict: The station dict
     :return: Does station provide enough reports for analysis
     """
     station_name = station_dict["name"]
     station_df = station_dict["data_frame"]
-    for year in station_df.index.year.unique():
-        year_key = str(year)
-        year_df = station_df.loc[year_key:year_key]  # avoids getting a series if a single entry exists
-        if year_df.empty or year_df.temperature.count() == 0:
-            logging.debug(station_name + " is an empty data frame")
-            return False
-        for month in year_df.index.month.unique():
-            month_key = "{year}-{month}".format(year=year, month=month)
-            month_df = year_df.loc[month_key:month_key]  # avoids getting a series if a single entry exists
-            if month_df.empty or month_df.temperature.count() < 22:  # obs for less than 22d
-                logging.debug(month_key + " " + station_name + " got less than 22 entries - must be less than 80%")
-                return False
-            for day in month_df.index.day.unique():
-                day_key = "{year}-{month}-{day}".format(year=year, month=month, day=day)
-                day_df = month_df.loc[day_key:day_key]  # avoids getting a series if a single entry exists
-                if day_df.temperature.count() < 19 or len(day_df.index.hour.unique()) < 19:
-                    # logging.debug("remove {day_key}".format(day_key=day_key))
-                    station_df.loc[day_key:day_key, "temperature"] = numpy.nan
-            station_df.dropna(axis='index', how='any', subset=["temperature"], inplace=True)
-            eighty_percent_of_month = int(round(calendar.monthrange(year, month)[1] * .8))
-            days_with_enough_reports = len(month_df.index.day.unique())
-            if days_with_enough_reports < eighty_percent_of_month:
-                logging.debug(month_key + " " + station_name + " only got " + str(days_with_enough_reports)
-                              + " but needed " + str(eighty_percent_of_month))
-                return False
+    if station_df.empty:
+        return True
+    has_temperature = station_df.temperature.notnull()
+
+    # one pass over the index: reports and distinct hours per day
+    days = station_df.index.normalize()
+    reports_per_day = has_temperature.astype(int).groupby(days).sum()
+    hours_per_day = pandas.Series(station_df.index.hour, index=station_df.index).groupby(days).nunique()
+    has_day_enough_reports = (reports_per_day >= 19) & (hours_per_day >= 19)
+
+    reports_per_year = reports_per_day.groupby(reports_per_day.index.year).sum()
+    if (reports_per_year == 0).any():
+        logging.debug(station_name + " is an empty data frame")
+        return False
+
+    months = reports_per_day.index.year * 100 + reports_per_day.index.month
+    reports_per_month = reports_per_day.groupby(months).sum()
+    if (reports_per_month < 22).any():  # obs for less than 22d
+        month = reports_per_month.index[(reports_per_month < 22).values][0]
+        logging.debug("{year}-{month} {station} got less than 22 entries - must be less than 80%".format(
+            year=month // 100, month=month % 100, station=station_name))
+        return False
+
+    # like before, every day with a row in the month counts, also those removed for too few reports
+    days_with_enough_reports = reports_per_day.groupby(months).size()
+    days_per_month = numpy.array([calendar.monthrange(month // 100, month % 100)[1]
+                                  for month in days_with_enough_reports.index])
+    eighty_percent_of_month = numpy.round(days_per_month * .8).astype(int)
+    is_month_too_sparse = days_with_enough_reports.values < eighty_percent_of_month
+    if is_month_too_sparse.any():
+        i = numpy.flatnonzero(is_month_too_sparse)[0]
+        month = days_with_enough_reports.index[i]
+        logging.debug("{year}-{month} {station} only got {days} but needed {needed}".format(
+            year=month // 100, month=month % 100, station=station_name,
+            days=int(days_with_enough_reports.values[i]), needed=eighty_percent_of_month[i]))
+        return False
+
+    is_row_kept = has_temperature.values & has_day_enough_reports.reindex(days).values
+    station_dict["data_frame"] = station_df[is_row_kept]
     return True
 
 
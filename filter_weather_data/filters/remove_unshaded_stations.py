@@ -10,6 +10,7 @@ import pandas
 import scipy.stats
 
 from . import StationRepository
+from . import StationMatrix
 from gather_weather_data.husconet import load_husconet_temperature_average
 from gather_weather_data.husconet import load_husconet_radiation_average
 from gather_weather_data.husconet import GermanWinterTime
@@ -24,6 +25,9 @@ P_VALUE = .01
 # correlation coefficient
 CORRELATION_COEFFICIENT = .5
 
+# the number of stations checked at once, limits the memory needed for the float64 temporaries
+STATION_BLOCK_SIZE = 32
+
 
 def check_station(station_df, reference_temperature_df, reference_radiation_df, just_check_correlation=False):
     """
@@ -91,6 +95,85 @@ def check_station(station_df, reference_temperature_df, reference_radiation_df,
         return True
 
 
+def get_correlations(temperature_deltas, radiations):
+    """
+    Works like ``scipy.stats.linregress`` for each column but only returns the correlation coefficient and the p value.
+    Rows with a NaN in either value are ignored column by column.
+
+    :param temperature_deltas: The temperature deltas, one column per station
+    :param radiations: The radiation values, one column per station or one column shared by all stations
+    :return: The correlation coefficients, the p values and whether a linear regression was possible at all
+    """
+    valid = ~numpy.isnan(temperature_deltas) & ~numpy.isnan(radiations)
+    n = valid.sum(axis=0)
+    divisor = numpy.maximum(n, 1)
+    x = numpy.where(valid, temperature_deltas, 0)
+    y = numpy.where(valid, radiations, 0)
+    dx = numpy.where(valid, x - x.sum(axis=0) / divisor, 0)
+    dy = numpy.where(valid, y - y.sum(axis=0) / divisor, 0)
+    ssxm = (dx * dx).sum(axis=0)
+    ssym = (dy * dy).sum(axis=0)
+    ssxym = (dx * dy).sum(axis=0)
+
+    # scipy refuses empty input and input with identical x values
+    x_is_constant = numpy.where(valid, temperature_deltas, numpy.inf).min(axis=0, initial=numpy.inf) == \
+        numpy.where(valid, temperature_deltas, -numpy.inf).max(axis=0, initial=-numpy.inf)
+    is_possible = (n > 0) & ~(x_is_constant & (n > 1))
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        r_values = numpy.clip(ssxym / numpy.sqrt(ssxm * ssym), -1, 1)
+        r_values[(ssxm == 0) | (ssym == 0)] = 0
+        degrees_of_freedom = n - 2
+        tiny = 1.0e-20
+        t_values = r_values * numpy.sqrt(degrees_of_freedom / ((1.0 - r_values + tiny) * (1.0 + r_values + tiny)))
+        p_values = 2 * scipy.stats.t.sf(numpy.abs(t_values), degrees_of_freedom)
+    p_values[n == 2] = numpy.where(ssym[n == 2] == 0, 1.0, 0.0)
+    p_values[n < 2] = numpy.nan
+    return r_values, p_values, is_possible
+
+
+def check_stations(station_matrix, reference_temperature_df, reference_radiation_df):
+    """
+    Works like ``check_station`` but for all stations of a matrix at once. The station values are not modified.
+    The stations are processed in blocks of STATION_BLOCK_SIZE columns.
+
+    :param station_matrix: The stations to check
+    :type station_matrix: StationMatrix
+    :param reference_temperature_df: The reference temperatures
+    :param reference_radiation_df: The reference radiation
+    :return: Is each station at a shaded place with high probability and which values are removed by the sigma*3 rule
+    :rtype: (``numpy.ndarray``, ``numpy.ndarray``)
+    """
+    reference_temperatures = reference_temperature_df.temperature.reindex(station_matrix.index).values
+    reference_standard_deviations = reference_temperature_df.temperature_std.reindex(station_matrix.index).values
+    radiations = reference_radiation_df.radiation.reindex(station_matrix.index).values
+    is_sunshine = radiations > SUNSHINE_MINIMUM_THRESHOLD
+    upper_limits = reference_temperatures + (reference_standard_deviations * 3)
+
+    stations_shaded = numpy.zeros(len(station_matrix), dtype=bool)
+    extreme_values = numpy.zeros((len(station_matrix.index), len(station_matrix)), dtype=bool)
+    for block_start in range(0, len(station_matrix), STATION_BLOCK_SIZE):
+        block = slice(block_start, block_start + STATION_BLOCK_SIZE)
+        temperatures = station_matrix.values[:, block]
+        temperature_deltas = temperatures[is_sunshine].astype(numpy.float64)
+        temperature_deltas -= reference_temperatures[is_sunshine, numpy.newaxis]
+        r_values, p_values, is_possible = get_correlations(temperature_deltas, radiations[is_sunshine, numpy.newaxis])
+        del temperature_deltas
+        for station_name in station_matrix.station_names[block][~is_possible]:
+            logging.warning("No linear regression possible for {station}. Did you check for infrequent reporting?"
+                            .format(station=station_name))
+
+        # Is the station at an unshaded position?
+        stations_unshaded = (r_values > CORRELATION_COEFFICIENT) & (p_values < P_VALUE)
+        stations_shaded[block] = is_possible & ~stations_unshaded
+
+        # Remove extreme values, level C2
+        with numpy.errstate(invalid="ignore"):
+            numpy.greater(temperatures, upper_limits[:, numpy.newaxis], out=extreme_values[:, block])
+        extreme_values[:, block] &= stations_shaded[block]
+    return stations_shaded, extreme_values
+
+
 def filter_stations(station_dicts, start_date, end_date):
     """
 
@@ -99,14 +182,53 @@ def filter_stations(station_dicts, start_date, end_date):
     :param time_zone: The time zone to apply to the reference values
     :param station_dicts: The station dicts
     """
+    return filter_stations_with_reference(station_dicts, *load_reference_data(start_date, end_date))
 
-    reference_temperature_df = load_husconet_temperature_average(start_date, end_date)
-    reference_radiation_df = load_husconet_radiation_average(start_date, end_date)
 
+def load_reference_data(start_date, end_date):
+    """
+    Loads the reference once so that it can be shared by several calls of ``filter_stations_with_reference``.
+
+    :return: The arguments for ``filter_stations_with_reference``
+    """
+    return load_husconet_temperature_average(start_date, end_date), load_husconet_radiation_average(start_date,
+                                                                                                    end_date)
+
+
+def filter_stations_with_reference(station_dicts, reference_temperature_df, reference_radiation_df):
+    """
+    Works like ``filter_stations`` with the reference loaded by ``load_reference_data``.
+
+    :param station_dicts: The station dicts
+    :param reference_temperature_df: The reference temperatures
+    :param reference_radiation_df: The reference radiation
+    """
+    # align the stations against the reference, only a block of them at once
+    station_dicts = list(station_dicts)
+    index = reference_temperature_df.index
     filtered_stations = []
-    for station_dict in station_dicts:
-        # logging.debug("unshaded " + station_dict["name"])
-        if check_station(station_dict["data_frame"], reference_temperature_df, reference_radiation_df):
+    for block_start in range(0, len(station_dicts), STATION_BLOCK_SIZE):
+        block_station_dicts = station_dicts[block_start:block_start + STATION_BLOCK_SIZE]
+        station_matrix = StationMatrix.from_station_dicts(
+            block_station_dicts, index, numpy.empty((len(index), len(block_station_dicts)), dtype=numpy.float64)
+        )
+        stations_shaded, extreme_values = check_stations(station_matrix, reference_temperature_df,
+                                                         reference_radiation_df)
+        del station_matrix
+
+        for j, station_dict in enumerate(block_station_dicts):
+            if not stations_shaded[j]:
+                continue
+            station_df = station_dict["data_frame"]
+            if extreme_values[:, j].any():
+                before = station_df.temperature.count()
+                station_df.loc[station_df.index.isin(index[extreme_values[:, j]]), "temperature"] = numpy.nan
+                after = station_df.temperature.count()
+                logging.debug("removed by sigma*3 rule: before: {before}, after: {after}, diff: {diff}".format(
+                    before=before, after=after, diff=before-after
+                ))
+                if after == 0:
+                    continue
             filtered_stations.append(station_dict)
     return filtered_stations
 
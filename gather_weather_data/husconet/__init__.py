@@ -5,6 +5,7 @@
 import os
 import datetime
 import logging
+import collections
 
 import dateutil.parser
 import pandas
@@ -68,6 +69,42 @@ class GermanWinterTime(datetime.tzinfo):
         return datetime.timedelta(0)
 
 
+def get_fixed_utc_offset(time_zone):
+    """
+
+    :param time_zone: The time zone, e.g. 'CET' or GermanWinterTime()
+    :type time_zone: datetime.tzinfo | str
+    :return: The offset to UTC if the time zone uses the same offset all year round, else None
+    :rtype: datetime.timedelta | None
+    """
+    if isinstance(time_zone, (GermanWinterTime, datetime.timezone)):
+        return time_zone.utcoffset(None)
+    if time_zone in ("UTC", "utc"):
+        return datetime.timedelta(0)
+    return None
+
+
+def convert_utc_to_local_time(data_frame, time_zone):
+    """
+    Works like ``data_frame.tz_localize("UTC").tz_convert(time_zone).tz_localize(None)``. Time zones with a fixed
+    offset such as ``GermanWinterTime`` are applied as one shift of the whole index instead of asking the time zone
+    for each entry.
+
+    :param data_frame: The data frame with a naive index in UTC or a time zone aware index
+    :param time_zone: The time zone, e.g. 'CET' or GermanWinterTime()
+    :type time_zone: datetime.tzinfo | str
+    :return: The data frame with a naive index in local time
+    """
+    if data_frame.index.tz is not None:
+        return data_frame.tz_convert(time_zone).tz_localize(None)
+    utc_offset = get_fixed_utc_offset(time_zone)
+    if utc_offset is None:
+        return data_frame.tz_localize("UTC").tz_convert(time_zone).tz_localize(None)
+    data_frame = data_frame.copy(deep=False)
+    data_frame.index = data_frame.index + pandas.Timedelta(utc_offset)
+    return data_frame
+
+
 def load_husconet_temperature_average(start_date, end_date, excluded_husconet_stations=None):
     if excluded_husconet_stations is not None:
         excluded_husconet_stations = list(excluded_husconet_stations)
@@ -144,7 +181,91 @@ def load_husconet_station(husconet_station_name, start_date=None, end_date=None,
     return load_husconet_file(csv_file, start_date, end_date, attribute_to_load=attribute_to_load)
 
 
-def load_husconet_file(csv_file, start_date=None, end_date=None, attribute_to_check=None, attribute_to_load=None):
+class HusconetFileCache:
+    """
+    Keeps the complete data frames of recently loaded husconet files. Requests for a time span are answered by slicing
+    the complete data frame, requests for a single attribute also by selecting the column of a complete file. The
+    least recently used data frames are evicted once their size exceeds ``max_bytes``. A file which has been modified
+    since it was loaded is loaded again.
+    """
+
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        """
+
+        :param max_bytes: The maximum size of all cached data frames in bytes
+        """
+        self.max_bytes = max_bytes
+        self.data_frames = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # the time spans for which the data outside the span has been checked already, only kept for cached files
+        self.checked_spans = set()
+
+    @staticmethod
+    def get_key(csv_file, attribute_to_load):
+        return os.path.realpath(csv_file), os.path.getmtime(csv_file), attribute_to_load
+
+    def get(self, csv_file, attribute_to_load):
+        """
+
+        :return: The complete data frame or None if it is not cached
+        :rtype: ``pandas.DataFrame`` | None
+        """
+        key = self.get_key(csv_file, attribute_to_load)
+        data_frame = None
+        if key in self.data_frames:
+            data_frame = self.data_frames[key]
+            self.data_frames.move_to_end(key)
+        elif attribute_to_load is not None:
+            key_of_all_attributes = self.get_key(csv_file, None)
+            if key_of_all_attributes in self.data_frames:
+                data_frame = self.data_frames[key_of_all_attributes][[attribute_to_load]]
+                self.data_frames.move_to_end(key_of_all_attributes)
+        if data_frame is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data_frame
+
+    def put(self, csv_file, attribute_to_load, data_frame):
+        """
+
+        :param data_frame: The complete data frame, it must not be modified afterwards
+        """
+        key = self.get_key(csv_file, attribute_to_load)
+        size = int(data_frame.memory_usage(index=True, deep=True).sum())
+        if key in self.data_frames or size > self.max_bytes:
+            return
+        while self.data_frames and self.bytes + size > self.max_bytes:
+            evicted_key, evicted_data_frame = self.data_frames.popitem(last=False)
+            self.bytes -= int(evicted_data_frame.memory_usage(index=True, deep=True).sum())
+            if not self.is_file_cached(evicted_key[:2]):
+                self.checked_spans = {span for span in self.checked_spans if span[0][:2] != evicted_key[:2]}
+        self.data_frames[key] = data_frame
+        self.bytes += size
+
+    def is_file_cached(self, file_key):
+        """
+
+        :param file_key: The path and the modification time of the file as in ``get_key``
+        :return: Whether a data frame of the file is cached, with all attributes or with a single one
+        """
+        return any(key[:2] == file_key for key in self.data_frames)
+
+    def clear(self):
+        self.data_frames.clear()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.checked_spans.clear()
+
+
+HUSCONET_FILE_CACHE = HusconetFileCache()
+
+
+def load_husconet_file(csv_file, start_date=None, end_date=None, attribute_to_check=None, attribute_to_load=None,
+                       copy=True):
     """
 
     :param start_date: The start date
@@ -157,6 +278,8 @@ def load_husconet_file(csv_file, start_date=None, end_date=None, attribute_to_ch
     :type attribute_to_check: str | None
     :param attribute_to_load: Load only a single attribute from the csv if provided, else load all existent attributes
     :type attribute_to_load: str | None
+    :param copy: If deactivated, the returned data frame may share its data with the cache and must not be modified
+    :type copy: bool
     :return: The loaded data frame within the time span
     :rtype: ``pandas.DataFrame``
     """
@@ -165,31 +288,33 @@ def load_husconet_file(csv_file, start_date=None, end_date=None, attribute_to_ch
     if isinstance(end_date, str):
         end_date = dateutil.parser.parse(end_date)
 
-    if not hasattr(load_husconet_file, "cache"):
-        load_husconet_file.cache = {}
-    key = (csv_file + "s" + repr(start_date) + "e" + repr(end_date) + "a" + repr(attribute_to_check)
-           + "l" + repr(attribute_to_load))
-    if key in load_husconet_file.cache:
-        return load_husconet_file.cache[key]
+    husconet_station_df = HUSCONET_FILE_CACHE.get(csv_file, attribute_to_load)
+    if husconet_station_df is None:
+        if attribute_to_load is None:
+            husconet_station_df = pandas.read_csv(csv_file, index_col="datetime", parse_dates=["datetime"])
+        else:
+            husconet_station_df = pandas.read_csv(
+                csv_file,
+                usecols=["datetime", attribute_to_load],
+                index_col="datetime",
+                parse_dates=["datetime"]
+            )
+        husconet_station_df = convert_utc_to_local_time(husconet_station_df, GermanWinterTime())
+        HUSCONET_FILE_CACHE.put(csv_file, attribute_to_load, husconet_station_df)
 
-    if attribute_to_load is None:
-        husconet_station_df = pandas.read_csv(csv_file, index_col="datetime", parse_dates=["datetime"])
-    else:
-        husconet_station_df = pandas.read_csv(
-            csv_file,
-            usecols=["datetime", attribute_to_load],
-            index_col="datetime",
-            parse_dates=["datetime"]
-        )
-    husconet_station_df = husconet_station_df.tz_localize("UTC").tz_convert(GermanWinterTime()).tz_localize(None)
+    # warn only once about data outside of the same time span
+    span = (HUSCONET_FILE_CACHE.get_key(csv_file, attribute_to_load), start_date, end_date, attribute_to_check)
+    check_span = span not in HUSCONET_FILE_CACHE.checked_spans
+    if HUSCONET_FILE_CACHE.is_file_cached(span[0][:2]):
+        HUSCONET_FILE_CACHE.checked_spans.add(span)
 
     if start_date is not None:
         before_start = husconet_station_df[:(start_date - datetime.timedelta(minutes=1))]
-        if attribute_to_check is not None and before_start[attribute_to_check].count() > 0:
+        if check_span and attribute_to_check is not None and before_start[attribute_to_check].count() > 0:
             logging.warning("Husconet data found before start date '{start_date}'".format(start_date=start_date))
             logging.info(before_start.describe())
             before_start.info()
-        elif not before_start.empty:
+        elif check_span and not before_start.empty:
             logging.warning("Husconet data found before start date '{start_date}'".format(start_date=start_date))
             logging.info(before_start.describe())
             before_start.info()
@@ -198,15 +323,16 @@ def load_husconet_file(csv_file, start_date=None, end_date=None, attribute_to_ch
     if end_date is not None:
         after_end_date = (end_date + datetime.timedelta(days=1))
         after_end_df = husconet_station_df[after_end_date:]
-        if attribute_to_check is not None and after_end_df[attribute_to_check].count() > 0:
+        if check_span and attribute_to_check is not None and after_end_df[attribute_to_check].count() > 0:
             logging.warning("Husconet data found after end date '{end_date}'".format(end_date=after_end_date))
             logging.info(after_end_df.describe())
             after_end_df.info()
-        elif not after_end_df.empty:
+        elif check_span and not after_end_df.empty:
             logging.warning("Husconet data found after end date '{end_date}'".format(end_date=after_end_date))
             logging.info(after_end_df.describe())
             after_end_df.info()
         husconet_station_df = husconet_station_df[:after_end_date]
 
-    load_husconet_file.cache[key] = husconet_station_df.copy()
+    if copy:
+        return husconet_station_df.copy()
     return husconet_station_df
@@ -8,6 +8,7 @@ to start it as a standalone script.
 
 import os
 import logging
+import multiprocessing
 
 import pandas
 
@@ -51,19 +52,39 @@ def load_husconet_station(station):
     return df, lat, lon
 
 
-def load_stations():
+def convert_station(station):
+    """
+    Writes the processed csv file of a station.
+
+    :param station: Name of station.
+    :return: The position of the station (lat, lon)
+    """
+    logging.debug(station)
+    df, lat, lon = load_husconet_station(station)
+    csv_file_weather = os.path.join(PROCESSED_DATA_DIR, "husconet", station + ".csv")
+    df.to_csv(csv_file_weather)
+    return lat, lon
+
+
+def load_stations(processes=None):
+    """
+
+    :param processes: The number of worker processes, each one converts one station at a time. None uses one worker
+        per cpu
+    """
     csv_file_positions = os.path.join(PROCESSED_DATA_DIR, "husconet_positions.csv")
     output_dir = os.path.join(PROCESSED_DATA_DIR, "husconet")
     if not os.path.isdir(output_dir):
         os.mkdir(output_dir)
+    if processes == 1:
+        positions = [convert_station(station) for station in HUSCONET_STATIONS]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            positions = pool.map(convert_station, HUSCONET_STATIONS, chunksize=1)
     with open(csv_file_positions, "w") as f:
         f.write("station,lat,lon\n")
-        for station in HUSCONET_STATIONS:
-            logging.debug(station)
-            df, lat, lon = load_husconet_station(station)
+        for station, (lat, lon) in zip(HUSCONET_STATIONS, positions):
             f.write(station + "," + str(lat) + "," + str(lon) + "\n")
-            csv_file_weather = os.path.join(PROCESSED_DATA_DIR, "husconet", station + ".csv")
-            df.to_csv(csv_file_weather)
 
 
 if __name__ == "__main__":
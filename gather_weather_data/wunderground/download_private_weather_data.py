@@ -9,52 +9,66 @@ import datetime
 import time
 import logging
 import json
+import threading
+import concurrent.futures
 
 import requests
+import requests.adapters
 
 from . import WUNDERGROUND_RAW_DATA_DIR
 from . import WundergroundProperties
 from . import get_all_stations
 
 
-def get_data_for_day(station, day, force_overwrite):
+def _get_json_file_path(station_directory, station, day, force_overwrite):
     """
-    
-    :param force_overwrite: If not activated, existing data is kept instead of overwriting
-    :param station: The station id
-    :param day: The day
-    :return: Was the download successful
+
+    :return: The file to write the day to or None if the day has been downloaded before
     """
     yyyymmdd = day.strftime("%Y%m%d")
     yyyy_mm_dd = day.strftime("%Y-%m-%d")
-    logging.info(day.strftime("%Y-%m-%d"))
-    station_directory = os.path.join(WUNDERGROUND_RAW_DATA_DIR, station)
-    if not os.path.isdir(station_directory):
-        os.mkdir(station_directory)
 
     # Traditional format
     json_file_name = "{station_id}_{YYYYMMDD}.json".format(station_id=station, YYYYMMDD=yyyymmdd)
     json_file_path = os.path.join(station_directory, json_file_name)
     if os.path.isfile(json_file_path) and os.path.getsize(json_file_path) and not force_overwrite:
         logging.info("skip download for {station} at {yyyy_mm_dd}".format(station=station, yyyy_mm_dd=yyyy_mm_dd))
-        return True
+        return None
 
     # Format of foreign project
     json_file_name = "{station_id}_{YYYY_MM_DD}.json".format(station_id=station, YYYY_MM_DD=yyyy_mm_dd)
     json_file_path = os.path.join(station_directory, json_file_name)
     if os.path.isfile(json_file_path) and os.path.getsize(json_file_path) and not force_overwrite:
         logging.info("skip download for {station} at {yyyy_mm_dd}".format(station=station, yyyy_mm_dd=yyyy_mm_dd))
-        return True
+        return None
+    return json_file_path
 
-    history_query = "history_{YYYYMMDD}/q/pws:{station_id}.json".format(YYYYMMDD=yyyymmdd, station_id=station)
-    query_url = WundergroundProperties.get_api_url() + history_query
-    response = requests.get(query_url)
-    time.sleep(0.5)
-    if response.status_code != 200:
-        time.sleep(0.5)
-        response = requests.get(query_url)
-        if response.status_code != 200:
-            logging.warning("error for {station} at {YYYYMMDD}".format(station=station, YYYYMMDD=yyyymmdd))
+
+def _get_query_url(api_url, station, day):
+    history_query = "history_{YYYYMMDD}/q/pws:{station_id}.json".format(YYYYMMDD=day.strftime("%Y%m%d"),
+                                                                       station_id=station)
+    return api_url + history_query
+
+
+def _get_date(day):
+    """
+
+    :param day: The day, also as datetime
+    :type day: datetime.date | datetime.datetime
+    :return: The day as date so that it can be compared with the days of the manifest
+    :rtype: datetime.date
+    """
+    if isinstance(day, datetime.datetime):
+        return day.date()
+    return day
+
+
+def _save_response(station, day, response, json_file_path):
+    """
+
+    :return: Was the response saved, False if it contains an error or invalid json
+    """
+    yyyymmdd = day.strftime("%Y%m%d")
     if response.text:
         try:
             json_payload = response.json()
@@ -71,6 +85,204 @@ def get_data_for_day(station, day, force_overwrite):
     return False
 
 
+def get_data_for_day(station, day, force_overwrite):
+    """
+    
+    :param force_overwrite: If not activated, existing data is kept instead of overwriting
+    :param station: The station id
+    :param day: The day
+    :return: Was the download successful
+    """
+    yyyymmdd = day.strftime("%Y%m%d")
+    logging.info(day.strftime("%Y-%m-%d"))
+    station_directory = os.path.join(WUNDERGROUND_RAW_DATA_DIR, station)
+    if not os.path.isdir(station_directory):
+        os.mkdir(station_directory)
+
+    json_file_path = _get_json_file_path(station_directory, station, day, force_overwrite)
+    if json_file_path is None:
+        return True
+
+    query_url = _get_query_url(WundergroundProperties.get_api_url(), station, day)
+    response = requests.get(query_url)
+    time.sleep(0.5)
+    if response.status_code != 200:
+        time.sleep(0.5)
+        response = requests.get(query_url)
+        if response.status_code != 200:
+            logging.warning("error for {station} at {YYYYMMDD}".format(station=station, YYYYMMDD=yyyymmdd))
+    return _save_response(station, day, response, json_file_path)
+
+
+class TokenBucket:
+    """
+    Limits the requests of several threads to a given rate. Up to ``capacity`` requests may be sent at once, after
+    that one request per ``1 / rate`` seconds.
+    """
+
+    def __init__(self, rate, capacity=1):
+        """
+
+        :param rate: The tokens added per second
+        :param capacity: The maximum number of tokens
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+                self.last_update = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                waiting_time = (1 - self.tokens) / self.rate
+            time.sleep(waiting_time)
+
+
+class ConcurrentDownloader:
+    """
+    Downloads station days with a pool of threads which share one HTTP session. The requests are limited by a token
+    bucket, failed requests are retried with exponential backoff and the days which still failed are recorded in a
+    manifest so they can be retried later with ``retry_failed_days``.
+    """
+
+    # The file listing the station days which could not be downloaded
+    manifest_file_name = "failed_downloads.json"
+
+    def __init__(self, requests_per_minute=10, burst=1, max_workers=4, retries=3, backoff=1, timeout=30,
+                 force_overwrite=False, api_url=None, raw_data_dir=WUNDERGROUND_RAW_DATA_DIR):
+        """
+
+        :param requests_per_minute: The rate limit of the API key
+        :param burst: The number of requests which may be sent at once
+        :param max_workers: The number of threads and pooled connections
+        :param retries: How often a failed request is repeated
+        :param backoff: The waiting time in s before the first retry, it doubles with each further retry
+        :param timeout: The timeout of a request in s
+        :param force_overwrite: If not activated, existing data is kept instead of overwriting
+        :param api_url: The url to query, defaults to the wunderground api url (e.g. set a local server for testing)
+        :param raw_data_dir: Where to store the downloaded data
+        """
+        self.token_bucket = TokenBucket(requests_per_minute / 60, burst)
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.force_overwrite = force_overwrite
+        self.api_url = api_url if api_url is not None else WundergroundProperties.get_api_url()
+        self.raw_data_dir = raw_data_dir
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get_data_for_day(self, station, day):
+        """
+
+        :param station: The station id
+        :param day: The day
+        :return: Was the download successful
+        """
+        station_directory = os.path.join(self.raw_data_dir, station)
+        os.makedirs(station_directory, exist_ok=True)
+        json_file_path = _get_json_file_path(station_directory, station, day, self.force_overwrite)
+        if json_file_path is None:
+            return True
+
+        query_url = _get_query_url(self.api_url, station, day)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            self.token_bucket.acquire()
+            try:
+                response = self.session.get(query_url, timeout=self.timeout)
+            except requests.RequestException as request_exception:
+                logging.warning("error for {station} at {day}: {exception}".format(
+                    station=station, day=day.strftime("%Y%m%d"), exception=request_exception))
+                continue
+            if response.status_code != 200:
+                logging.warning("error for {station} at {day}: status {status_code}".format(
+                    station=station, day=day.strftime("%Y%m%d"), status_code=response.status_code))
+                continue
+            if _save_response(station, day, response, json_file_path):
+                return True
+            # the API answers with an error in the json payload (e.g. when the rate limit is exceeded) or the
+            # payload is incomplete, both is worth another try
+        return False
+
+    def get_data_for_days(self, station_days):
+        """
+
+        :param station_days: The station ids and days to download
+        :type station_days: list of (str, datetime.date | datetime.datetime)
+        :return: The station days which failed, they are also recorded in the manifest
+        """
+        station_days = [(station, _get_date(day)) for station, day in station_days]
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+            successes = list(executor.map(lambda station_day: self.get_data_for_day(*station_day), station_days))
+        failed_station_days = [station_day for station_day, success in zip(station_days, successes) if not success]
+        self._update_manifest(station_days, failed_station_days)
+        logging.info("{failed} of {total} days failed".format(failed=len(failed_station_days),
+                                                              total=len(station_days)))
+        return failed_station_days
+
+    def get_data_for_time_span(self, stations, start_date, end_date):
+        """
+
+        :param stations: The station ids
+        :param start_date: The start date (included)
+        :type start_date: datetime.date | datetime.datetime
+        :param end_date: The end date (included)
+        :type end_date: datetime.date | datetime.datetime
+        :return: The station days which failed
+        """
+        start_date, end_date = _get_date(start_date), _get_date(end_date)
+        days = [start_date + datetime.timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+        return self.get_data_for_days([(station, day) for station in stations for day in days])
+
+    def retry_failed_days(self):
+        """
+
+        :return: The station days which failed again
+        """
+        return self.get_data_for_days(self.load_manifest())
+
+    def _get_manifest_file(self):
+        return os.path.join(self.raw_data_dir, self.manifest_file_name)
+
+    def load_manifest(self):
+        """
+
+        :return: The station days which failed before
+        """
+        manifest_file = self._get_manifest_file()
+        if not os.path.isfile(manifest_file):
+            return []
+        with open(manifest_file) as f:
+            return [(entry["station"], datetime.datetime.strptime(entry["day"], "%Y-%m-%d").date())
+                    for entry in json.load(f)]
+
+    def _update_manifest(self, tried_station_days, failed_station_days):
+        tried_station_days = set(tried_station_days)
+        station_days = [station_day for station_day in self.load_manifest() if station_day not in tried_station_days]
+        station_days += failed_station_days
+        manifest_file = self._get_manifest_file()
+        temporary_file = manifest_file + "." + str(os.getpid()) + ".tmp"
+        with open(temporary_file, "w") as f:
+            json.dump([{"station": station, "day": day.strftime("%Y-%m-%d")} for station, day in station_days], f,
+                      indent=2)
+        os.replace(temporary_file, manifest_file)
+
+
 def get_station_data_for_time_span(station, start_date, end_date, force_overwrite):
     """
     
@@ -101,11 +313,10 @@ def demo():
     start_date = datetime.date(2016, 1, 1)
     end_date = datetime.date(2016, 1, 31)
     stations = get_all_stations()
-    for station in stations:
-        logging.info("Station: {station}".format(station=station))
-        success = get_station_data_for_time_span(station, start_date, end_date, force_overwrite=False)
-        if not success:
-            break
+    downloader = ConcurrentDownloader()
+    failed_station_days = downloader.get_data_for_time_span(stations, start_date, end_date)
+    if failed_station_days:
+        logging.info("Some days failed - please re-run once the servers are up again.")
 
 
 if __name__ == "__main__":
@@ -9,9 +9,11 @@ to run the demo
 """
 
 import os
+import re
 import json
 import datetime
 import logging
+import functools
 
 import numpy
 import pandas
@@ -19,10 +21,11 @@ import pandas
 import metar.Metar  # needs https://github.com/tomp/python-metar/pull/25 to work stable
 
 from . import WUNDERGROUND_RAW_AIRPORT_DATA_DIR
-from . import PROCESSED_DATA_DIR
 from .summarize_raw_data import _parse_utc_date
 from .summarize_raw_data import _cast_number
 from .summarize_raw_data import _get_file_name
+from .summarize_raw_data import _get_span_summary_path
+from .summarize_raw_data import _write_span_summary
 
 
 HEADER_FORMAT = ("{datetime},{temperature},{dewpoint},{windspeed},{windgust},{winddirection},{pressure},{humidity},"
@@ -48,35 +51,81 @@ def max_of_total_order(collection_of_interest, given_total_order):
     return given_total_order[max(l)]
 
 
+SORTED_POSSIBLE_CLOUD_COVERS = [
+    "SKC", "CLR", "NSC",  # 0 octas
+    "FEW",  # 1-2 octas
+    "SCT",  # 3-4 octas
+    "BKN",  # 5-7 octas
+    "OVC",  # 8 octas
+    "VV",  # clouds can not be seen because of fog or rain
+]
+
+CLOUD_COVER_RANKS = {cover: rank for rank, cover in enumerate(SORTED_POSSIBLE_CLOUD_COVERS)}
+
+# A usual sky group such as 'FEW020', 'BKN100CB', 'OVC///' or 'NSC'
+SKY_GROUP_RE = re.compile(r"^(?P<cover>VV|CLR|SKC|SCK|NSC|FEW|SCT|BKN|OVC|0VC)(\d{2,4}|///)?([A-Z][A-Z]+|///)?$")
+
+# Everything which the METAR parser might take as a sky group
+SKY_GROUP_PREFIX_RE = re.compile(r"^(VV|CLR|SKC|SCK|NSC|NCD|BKN|SCT|FEW|[O0]VC|///)")
+
+# The sky groups after these groups are not part of the observation
+END_OF_BODY_GROUPS = frozenset(["TEMPO", "BECMG", "FCST", "NOSIG", "RMK", "RMKS", "NOSPECI"])
+
+# The METAR parser renames these covers
+COVER_ALIASES = {"SKC": "CLR", "SCK": "CLR", "0VC": "OVC"}
+
+
+def _get_sky_covers(metar_string):
+    """
+    Reads the covers of the sky groups like the METAR parser does, but only for usual reports.
+
+    :param metar_string: A classical meteorological METAR starting with type and station
+    :return: The covers or None if the report contains an unusual group which looks like a sky group
+    """
+    sky_covers = []
+    for group in metar_string.split()[2:]:
+        if group in END_OF_BODY_GROUPS:
+            break
+        if not SKY_GROUP_PREFIX_RE.match(group):
+            continue
+        sky_group_match = SKY_GROUP_RE.match(group)
+        if sky_group_match is None:
+            return None
+        cover = sky_group_match.group("cover")
+        sky_covers.append(COVER_ALIASES.get(cover, cover))
+    return sky_covers
+
+
+@functools.lru_cache(maxsize=2 ** 16)
+def _get_cloud_cover(metar_string, year, month):
+    sky_covers = _get_sky_covers(metar_string)
+    if sky_covers is None:
+        m = metar.Metar.Metar(
+            metar_string,
+            month,
+            year,
+            drop_unsupported_observations=True
+        )
+        if not m.sky:
+            return "CAVOC"  # 0 octas
+        sky_covers = [cover for (cover, height, cloud) in m.sky]
+        return max_of_total_order(sky_covers, SORTED_POSSIBLE_CLOUD_COVERS)
+    if not sky_covers:
+        return "CAVOC"  # 0 octas
+    return max(sky_covers, key=CLOUD_COVER_RANKS.__getitem__)
+
+
 def get_cloud_cover(metar_string, date_of_observation):
     """
     This needs a small modification as described in https://github.com/tomp/python-metar/pull/25
+    The sky groups of usual reports are read directly, only the others are handed to the METAR parser. The results
+    are memoized as the same reports show up for several days.
     
     :param metar_string: A classical meteorological METAR
     :param date_of_observation: Used to parse the metar at hand
     :return: The cloud cover name
     """
-    d = date_of_observation
-    m = metar.Metar.Metar(
-        metar_string,
-        d.month,
-        d.year,
-        drop_unsupported_observations=True
-    )
-    cloud_cover = "CAVOC"  # 0 octas
-    if not m.sky:
-        return cloud_cover
-    else:
-        sorted_possible_cloud_covers = [
-            "SKC", "CLR", "NSC",  # 0 octas
-            "FEW",  # 1-2 octas
-            "SCT",  # 3-4 octas
-            "BKN",  # 5-7 octas
-            "OVC",  # 8 octas
-            "VV",  # clouds can not be seen because of fog or rain
-        ]
-        sky_covers = [cover for (cover, height, cloud) in m.sky]
-        return max_of_total_order(sky_covers, sorted_possible_cloud_covers)
+    return _get_cloud_cover(metar_string, date_of_observation.year, date_of_observation.month)
 
 
 def _get_data_for_single_day(station, day):
@@ -175,33 +224,21 @@ def _create_csv_from_json(station, day, force_overwrite):
 def join_daily_summaries(station, start_date, end_date, force_overwrite):
     """
     
-    :param station: 
-    :param start_date: 
-    :param end_date: 
-    :param force_overwrite: 
-    :return: 
+    :param station: The name of the station, e.g. 'EDDH'
+    :param start_date: The date to start (included)
+    :param end_date: The date to stop (included)
+    :param force_overwrite: Whether to overwrite an old span summary file.
     """
-    date_to_check = start_date
-    span_summary_file_name = station + "_" + start_date.strftime("%Y%m%d") + "_" + end_date.strftime("%Y%m%d") + ".csv"
-    output_dir = os.path.join(PROCESSED_DATA_DIR, "station_summaries")
-    if not os.path.isdir(output_dir):
-        os.mkdir(output_dir)
-    span_summary_path = os.path.join(output_dir, span_summary_file_name)
-    if os.path.isdir(span_summary_path) and not force_overwrite:
+    span_summary_path = _get_span_summary_path(station, start_date, end_date)
+    if os.path.isfile(span_summary_path) and not force_overwrite:
         logging.info("skip " + span_summary_path)
         return
-    data_frame = _open_daily_summary(station, start_date)
-    start_date += datetime.timedelta(days=1)
+    data_frames = []
+    date_to_check = start_date
     while date_to_check <= end_date:
-        data_frame_next = _open_daily_summary(station, date_to_check)
-        data_frame = data_frame.append(data_frame_next)
+        data_frames.append(_open_daily_summary(station, date_to_check))
         date_to_check = date_to_check + datetime.timedelta(days=1)
-
-    # remove duplicates (happens if same entry exists for two days)
-    data_frame.groupby(data_frame.index).first()
-    data_frame.sort_index(inplace=True)
-
-    data_frame.to_csv(span_summary_path)
+    _write_span_summary(pandas.concat(data_frames), span_summary_path)
 
 
 def create_daily_summaries_for_time_span(station, start_date, end_date, force_overwrite):
@@ -9,11 +9,13 @@ to run the demo
 """
 
 import os
+import re
 import json
 import datetime
 import pytz
 import logging
-import re
+import multiprocessing
+import numpy
 import pandas
 
 from . import WUNDERGROUND_RAW_DATA_DIR
@@ -36,6 +38,29 @@ def _parse_utc_date(utc_date_json):
     return datetime.datetime(year, month, day, hour, minute, tzinfo=pytz.utc)
 
 
+# Values wunderground uses for missing data
+MISSING_VALUES = frozenset(["", "N/A"])
+MISSING_IMPERIAL_VALUES = frozenset(["-99.99", "-9999", "-999.0", "-999.9", "-9999.0"])
+
+# an integer or a float, anything else float() accepts (e.g. 'nan', '1e3' or ' 1') is rejected
+NUMBER_PATTERN = re.compile(r"^-?\d+$|^-?\d*\.\d+$")
+
+
+def _cast_float(val, imperial=""):
+    """
+    Works like ``_cast_number`` but returns NaN for missing values.
+
+    :param val: A metric value as it is supplied by wunderground
+    :param imperial: The imperial pendent to the value, used for determining NaNs
+    :return: A float
+    """
+    if val in MISSING_VALUES or imperial in MISSING_IMPERIAL_VALUES:
+        return numpy.nan
+    if not NUMBER_PATTERN.match(val):
+        raise RuntimeError("val not a number: " + repr(val))
+    return float(val)
+
+
 def _cast_number(val, imperial=""):
     """
     
@@ -43,18 +68,10 @@ def _cast_number(val, imperial=""):
     :param imperial: The imperial pendent to the value, used for determining NaNs
     :return: An integer or float
     """
-    if val == "" or val == "N/A":
+    number = _cast_float(val, imperial)
+    if numpy.isnan(number):
         return ""
-    if imperial:
-        if (imperial == "-99.99" or imperial == "-9999" or imperial == "-999.0"
-                or imperial == "-999.9" or imperial == "-9999.0"):
-            return ""
-    if re.match(r"^-?\d+$", val):  # an integer
-        return float(val)
-    if re.match(r"^-?\d*\.\d+$", val):  # a float
-        return float(val)
-    else:
-        raise RuntimeError("val not a number: " + repr(val))
+    return number
 
 
 def _get_file_name(station, day, file_ending):
@@ -81,14 +98,12 @@ def _get_header():
     return HEADER_FORMAT.replace("{", "").replace("}", "")
 
 
-def _get_data_for_single_day(station, day):
+def _load_json(station, day):
     """
-    At the current time the day provided is interpreted as local time at wunderground.
-    
+
     :param station: The name of the station, e.g. 'IHAMBURG69'
     :param day: The day to pick the json from
-    :return: A valid csv file content with header
-    :rtype: str
+    :return: The downloaded json or None if there is none
     """
     json_file_name = _get_file_name(station, day, 'json')
     json_file_path = os.path.join(WUNDERGROUND_RAW_DATA_DIR, station, json_file_name)
@@ -104,7 +119,21 @@ def _get_data_for_single_day(station, day):
         os.remove(json_file_path)
         return
     with open(json_file_path) as f:
-        raw_json_weather_data = json.load(f)
+        return json.load(f)
+
+
+def _get_data_for_single_day(station, day):
+    """
+    At the current time the day provided is interpreted as local time at wunderground.
+    
+    :param station: The name of the station, e.g. 'IHAMBURG69'
+    :param day: The day to pick the json from
+    :return: A valid csv file content with header
+    :rtype: str
+    """
+    raw_json_weather_data = _load_json(station, day)
+    if raw_json_weather_data is None:
+        return
 
     # These are the relevant observations we want to keep
     observations = []
@@ -169,6 +198,110 @@ def create_daily_summaries_for_time_span(station, start_date, end_date, force_ov
         date_to_check = date_to_check + datetime.timedelta(days=1)
 
 
+def _get_span_summary_path(station, start_date, end_date):
+    span_summary_file_name = station + "_" + start_date.strftime("%Y%m%d") + "_" + end_date.strftime("%Y%m%d") + ".csv"
+    output_dir = os.path.join(PROCESSED_DATA_DIR, "station_summaries")
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+    return os.path.join(output_dir, span_summary_file_name)
+
+
+def _write_span_summary(data_frame, span_summary_path):
+    """
+    Removes duplicates (happens if same entry exists for two days), sorts by time and writes the file atomically.
+    The summary stays a csv file as all readers (and other tools) expect it, ``read_summary_csv`` keeps a binary copy
+    for fast loading.
+
+    :param data_frame: The observations of all days
+    :param span_summary_path: The file to write
+    """
+    data_frame = data_frame[~data_frame.index.duplicated(keep="first")]
+    data_frame = data_frame.sort_index()
+    temporary_file = span_summary_path + "." + str(os.getpid()) + ".tmp"
+    data_frame.to_csv(temporary_file)
+    os.replace(temporary_file, span_summary_path)
+
+
+def _get_rows_for_single_day(station, day):
+    """
+    Works like ``_get_data_for_single_day`` but returns the observations as rows of floats.
+
+    :param station: The name of the station, e.g. 'IHAMBURG69'
+    :param day: The day to pick the json from
+    :return: The rows with year, month, day, hour and minute (UTC) followed by the values of the header
+    :rtype: list
+    """
+    raw_json_weather_data = _load_json(station, day)
+    if raw_json_weather_data is None:
+        return []
+    rows = []
+    for raw_observation in raw_json_weather_data["history"]["observations"]:
+        utc_date = raw_observation["utcdate"]
+        rows.append((
+            int(utc_date["year"]),
+            int(utc_date["mon"]),
+            int(utc_date["mday"]),
+            int(utc_date["hour"]),
+            int(utc_date["min"]),
+            _cast_float(raw_observation["tempm"]),
+            _cast_float(raw_observation["dewptm"]),
+            _cast_float(raw_observation["wspdm"], raw_observation["wspdi"]),
+            _cast_float(raw_observation["wgustm"], raw_observation["wgusti"]),
+            _cast_float(raw_observation["wdird"], raw_observation["wdird"]),
+            _cast_float(raw_observation["pressurem"]),
+            _cast_float(raw_observation["hum"]),
+            _cast_float(raw_observation["precip_ratem"], raw_observation["precip_ratei"])
+            if "precip_ratem" in raw_observation else numpy.nan
+        ))
+    return rows
+
+
+def create_span_summary(station, start_date, end_date, force_overwrite):
+    """
+    Creates the same span summary as ``create_daily_summaries_for_time_span`` followed by ``join_daily_summaries``
+    but directly from the json files without writing daily summaries.
+
+    :param station: The name of the station, e.g. 'IHAMBURG69'
+    :param start_date: The date to start (included)
+    :param end_date: The date to stop (included)
+    :param force_overwrite: Whether to overwrite an old span summary file.
+    """
+    span_summary_path = _get_span_summary_path(station, start_date, end_date)
+    if os.path.isfile(span_summary_path) and not force_overwrite:
+        logging.info("skip " + span_summary_path)
+        return
+    rows = []
+    date_to_check = start_date
+    while date_to_check <= end_date:
+        rows += _get_rows_for_single_day(station, date_to_check)
+        date_to_check = date_to_check + datetime.timedelta(days=1)
+
+    columns = _get_header().split(",")
+    values = numpy.array(rows, dtype=float).reshape(len(rows), len(columns) + 4)
+    date_parts = pandas.DataFrame(values[:, :5].astype(int), columns=["year", "month", "day", "hour", "minute"])
+    index = pandas.DatetimeIndex(pandas.to_datetime(date_parts, utc=True), name=columns[0])
+    _write_span_summary(pandas.DataFrame(values[:, 5:], index=index, columns=columns[1:]), span_summary_path)
+
+
+def create_span_summaries(stations, start_date, end_date, force_overwrite, processes=None):
+    """
+
+    :param stations: The names of the stations
+    :param start_date: The date to start (included)
+    :param end_date: The date to stop (included)
+    :param force_overwrite: Whether to overwrite old span summary files.
+    :param processes: The number of worker processes, each one summarizes one station at a time. None uses one
+        worker per cpu
+    """
+    arguments = [[station, start_date, end_date, force_overwrite] for station in stations]
+    if processes == 1:
+        for station_arguments in arguments:
+            create_span_summary(*station_arguments)
+        return
+    with multiprocessing.Pool(processes) as pool:
+        pool.starmap(create_span_summary, arguments, chunksize=1)
+
+
 def _open_daily_summary(station, day):
     """
     
@@ -184,45 +317,29 @@ def _open_daily_summary(station, day):
 def join_daily_summaries(station, start_date, end_date, force_overwrite):
     """
     
-    :param station: 
-    :param start_date: 
-    :param end_date: 
-    :param force_overwrite: 
-    :return: 
+    :param station: The name of the station, e.g. 'IHAMBURG69'
+    :param start_date: The date to start (included)
+    :param end_date: The date to stop (included)
+    :param force_overwrite: Whether to overwrite an old span summary file.
     """
-    date_to_check = start_date
-    span_summary_file_name = station + "_" + start_date.strftime("%Y%m%d") + "_" + end_date.strftime("%Y%m%d") + ".csv"
-    output_dir = os.path.join(PROCESSED_DATA_DIR, "station_summaries")
-    if not os.path.isdir(output_dir):
-        os.mkdir(output_dir)
-    span_summary_path = os.path.join(output_dir, span_summary_file_name)
-    if os.path.isdir(span_summary_path) and not force_overwrite:
+    span_summary_path = _get_span_summary_path(station, start_date, end_date)
+    if os.path.isfile(span_summary_path) and not force_overwrite:
         logging.info("skip " + span_summary_path)
         return
-    data_frame = _open_daily_summary(station, start_date)
-    start_date += datetime.timedelta(days=1)
+    data_frames = []
+    date_to_check = start_date
     while date_to_check <= end_date:
-        data_frame_next = _open_daily_summary(station, date_to_check)
-        data_frame = data_frame.append(data_frame_next)
+        data_frames.append(_open_daily_summary(station, date_to_check))
         date_to_check = date_to_check + datetime.timedelta(days=1)
-
-    # remove duplicates (happens if same entry exists for two days)
-    data_frame.groupby(data_frame.index).first()
-    data_frame.sort_index(inplace=True)
-
-    data_frame.to_csv(span_summary_path)
+    _write_span_summary(pandas.concat(data_frames), span_summary_path)
 
 
 def demo():
     stations = get_all_stations()
-    for station in stations:
-        logging.info(station)
-        start_date = datetime.datetime(2016, 1, 1)
-        end_date = datetime.datetime(2016, 12, 31)
-        logging.info("create daily summaries")
-        create_daily_summaries_for_time_span(station, start_date, end_date, False)
-        logging.info("create time span summary")
-        join_daily_summaries(station, start_date, end_date, True)
+    start_date = datetime.datetime(2016, 1, 1)
+    end_date = datetime.datetime(2016, 12, 31)
+    logging.info("create time span summaries")
+    create_span_summaries(stations, start_date, end_date, True)
 
 
 if __name__ == "__main__":
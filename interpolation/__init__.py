@@ -9,6 +9,9 @@ import dateutil.parser
 import pandas
 
 from gather_weather_data.husconet import GermanWinterTime
+from gather_weather_data.husconet import convert_utc_to_local_time
+from filter_weather_data.filters import read_summary_csv
+from filter_weather_data.filters import SummaryFileIndex
 
 
 PROJECT_ROOT_DIR = os.path.join(
@@ -23,34 +26,8 @@ PROCESSED_DATA_DIR = os.path.join(
 
 
 def _search_summary_file(station, start_date, end_date):
-    searched_station_summary_file_name = None
-    for station_summary_file_name in os.listdir(os.path.join(PROCESSED_DATA_DIR, "station_summaries")):
-        if not station_summary_file_name.endswith(".csv"):
-            continue
-        if not station_summary_file_name.startswith(station):
-            continue
-        station_summary_file_name = station_summary_file_name[:-4]  # cut of '.csv'
-        file_name_parts = station_summary_file_name.split("_")
-        if len(file_name_parts) == 1:
-            searched_station_summary_file_name = file_name_parts[0] + ".csv"
-            break
-        elif len(file_name_parts) == 3:
-            station_part, start_date_span_text, end_date_span_text = file_name_parts
-            if station_part != station:
-                continue
-            if start_date is None and end_date is None:
-                searched_station_summary_file_name = station_summary_file_name + ".csv"
-                break
-            start_date_span = datetime.datetime.strptime(start_date_span_text, "%Y%m%d")
-            start_date_span = start_date_span.replace(tzinfo=start_date.tzinfo)
-            start_date_span = start_date_span.replace(hour=0, minute=0)
-            end_date_span = datetime.datetime.strptime(end_date_span_text, "%Y%m%d")
-            end_date_span = end_date_span.replace(tzinfo=end_date.tzinfo)
-            end_date_span = end_date_span.replace(hour=23, minute=59)
-            if start_date_span <= start_date and end_date_span >= end_date:
-                searched_station_summary_file_name = station_summary_file_name + ".csv"
-                break
-    return searched_station_summary_file_name
+    summary_dir = os.path.join(PROCESSED_DATA_DIR, "station_summaries")
+    return SummaryFileIndex.for_directory(summary_dir).search(station, start_date, end_date)
 
 
 def load_airport(airport_name, start_date, end_date):
@@ -74,12 +51,8 @@ def load_airport(airport_name, start_date, end_date):
         "station_summaries",
         searched_summary_file_name
     )
-    station_df = pandas.read_csv(
-        csv_file,
-        index_col="datetime",
-        parse_dates=["datetime"]
-    )
-    station_df = station_df.tz_localize("UTC").tz_convert(GermanWinterTime()).tz_localize(None)
+    station_df = read_summary_csv(csv_file)
+    station_df = convert_utc_to_local_time(station_df, GermanWinterTime())
 
     if end_date.hour == 0 and end_date.minute == 0 and end_date.second == 0:
         # '2016-31-12' actually means until one minute before midnight, so it includes the last day
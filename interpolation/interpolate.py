@@ -7,6 +7,7 @@ import datetime
 import random
 import logging
 import itertools
+import multiprocessing
 import sys
 import os
 
@@ -17,17 +18,35 @@ from filter_weather_data.filters import StationRepository
 from filter_weather_data import get_repository_parameters
 from filter_weather_data import RepositoryParameter
 
+from .interpolator.abstract_neighbour_finder import AbstractNeighbourFinder
 from .interpolator.delaunay_triangulator import DelaunayTriangulator
 from .interpolator.nearest_k_finder import NearestKFinder
 from . import load_airport
 from .interpolator.statistical_interpolator import get_interpolation_results
+from .interpolator.statistical_interpolator import get_interpolation_results_for_dates
+
+
+# the number of time points scored at once, limits the memory needed for the neighbour arrays
+BATCH_SIZE = 10000
+
+# the number of threads reading station summaries ahead
+PREFETCH_THREADS = 4
 
 
 class Scorer:
-    def __init__(self, target_station_dict, neighbour_station_dicts, start_date, end_date):
+    def __init__(self, target_station_dict, neighbour_station_dicts, start_date, end_date,
+                 neighbour_station_matrix=None, distance_matrix=None):
         self.target_station_dict = target_station_dict
-        self.nearest_k_finder = NearestKFinder(neighbour_station_dicts, start_date, end_date)
-        self.delaunay_triangulator = DelaunayTriangulator(neighbour_station_dicts, start_date, end_date)
+        if neighbour_station_matrix is None:
+            neighbour_station_matrix = AbstractNeighbourFinder().sample_up_matrix(
+                neighbour_station_dicts, start_date, end_date
+            )
+        self.nearest_k_finder = NearestKFinder(neighbour_station_dicts, start_date, end_date,
+                                               station_matrix=neighbour_station_matrix,
+                                               distance_matrix=distance_matrix)
+        self.delaunay_triangulator = DelaunayTriangulator(neighbour_station_dicts, start_date, end_date,
+                                                          station_matrix=neighbour_station_matrix,
+                                                          distance_matrix=distance_matrix)
         self.airport_df = load_airport("EDDH", start_date, end_date)
 
     def score_nearest_neighbour(self, date, t_actual):
@@ -58,6 +77,29 @@ class Scorer:
         relevant_neighbours = self.nearest_k_finder.find_k_nearest_neighbours(self.target_station_dict, date, -1)
         return get_interpolation_results(relevant_neighbours, t_actual, "_all")
 
+    def score_airport_at_dates(self, dates, t_actual):
+        t_eddh = self.airport_df.temperature.reindex(dates).values
+        return (t_eddh - t_actual) ** 2
+
+    def score_nearest_neighbours_at_dates(self, dates, t_actual):
+        temperatures, distances = self.nearest_k_finder.find_k_nearest_neighbours_for_dates(
+            self.target_station_dict, dates, -1
+        )
+        # the neighbours are sorted by distance, so the first k columns are the k nearest available ones
+        results = {
+            "nn": (temperatures[:, 0] - t_actual) ** 2
+        }
+        results.update(get_interpolation_results_for_dates(temperatures[:, :3], distances[:, :3], t_actual, "_cn3"))
+        results.update(get_interpolation_results_for_dates(temperatures[:, :5], distances[:, :5], t_actual, "_cn5"))
+        results.update(get_interpolation_results_for_dates(temperatures, distances, t_actual, "_all"))
+        return results
+
+    def score_delaunay_neighbours_at_dates(self, dates, t_actual):
+        temperatures, distances = self.delaunay_triangulator.find_delaunay_neighbours_for_dates(
+            self.target_station_dict, dates
+        )
+        return get_interpolation_results_for_dates(temperatures, distances, t_actual, "_dt")
+
 
 def score_interpolation_algorithm_at_date(scorer, date):
     t_actual = scorer.target_station_dict["data_frame"].loc[date].temperature
@@ -72,6 +114,24 @@ def score_interpolation_algorithm_at_date(scorer, date):
     return results
 
 
+def score_interpolation_algorithm_at_dates(scorer, dates):
+    """
+    Works like ``score_interpolation_algorithm_at_date`` but for many time points at once.
+
+    :param scorer: The scorer of the target station
+    :param dates: The time points to score
+    :return: The square errors per method, NaN if the method could not be applied at that time point
+    :rtype: dict
+    """
+    t_actual = scorer.target_station_dict["data_frame"].temperature.reindex(dates).values
+    results = {
+        "eddh": scorer.score_airport_at_dates(dates, t_actual),
+    }
+    results.update(scorer.score_nearest_neighbours_at_dates(dates, t_actual))
+    results.update(scorer.score_delaunay_neighbours_at_dates(dates, t_actual))
+    return results
+
+
 def setup_logging(interpolation_name):
     log = logging.getLogger('')
 
@@ -107,30 +167,49 @@ def do_interpolation_scoring(
         target_station_dicts_len,
         neighbour_station_dicts,
         start_date,
-        end_date
+        end_date,
+        score_each_minute=False,
+        neighbour_station_matrix=None,
+        distance_matrix=None,
+        seed=None
 ):
+    """
+    Scores the interpolation methods for one target station.
+
+    :param seed: Seeds the choice of the random minute per hour, e.g. the seed of the run plus the position of the
+        target. Worker processes do not share a random state, so without a seed per target the choices depend on
+        how the targets are distributed across the workers.
+    """
+    random_generator = numpy.random.default_rng(seed)
     target_station_name = target_station_dict["name"]
     logging.info("interpolate for " + target_station_name)
     logging.info("currently at " + str(j + 1) + " out of " + target_station_dicts_len)
     logging.info("use " + " ".join([station_dict["name"] for station_dict in neighbour_station_dicts]))
+    if target_station_dict["data_frame"].empty:
+        logging.info("no data for " + target_station_name)
+        return pandas.DataFrame()
 
-    scorer = Scorer(target_station_dict, neighbour_station_dicts, start_date, end_date)
+    scorer = Scorer(target_station_dict, neighbour_station_dicts, start_date, end_date, neighbour_station_matrix,
+                    distance_matrix)
     scorer.nearest_k_finder.sample_up(target_station_dict, start_date, end_date)
     sum_square_errors = {}
     total_len = len(target_station_dict["data_frame"].index.values)
     each_minute = target_station_dict["data_frame"].index.values
-    grouped_by_hour = numpy.array_split(each_minute, total_len / 60)
-    each_hour = [numpy.random.choice(hour_group) for hour_group in grouped_by_hour]
-    for current_i, date in enumerate(each_hour):
-        result = score_interpolation_algorithm_at_date(scorer, date)
-        for method, square_error in result.items():
+    if score_each_minute:
+        dates = each_minute
+    else:
+        grouped_by_hour = numpy.array_split(each_minute, total_len / 60)
+        dates = numpy.array([random_generator.choice(hour_group) for hour_group in grouped_by_hour])
+    for batch in numpy.array_split(dates, max(1, int(numpy.ceil(len(dates) / BATCH_SIZE)))):
+        result = score_interpolation_algorithm_at_dates(scorer, pandas.DatetimeIndex(batch))
+        for method, square_errors in result.items():
             if method not in sum_square_errors:
                 sum_square_errors[method] = {}
                 sum_square_errors[method]["total"] = 0
                 sum_square_errors[method]["n"] = 0
-            if not numpy.isnan(square_error):
-                sum_square_errors[method]["total"] += square_error
-                sum_square_errors[method]["n"] += 1
+            is_scored = ~numpy.isnan(square_errors)
+            sum_square_errors[method]["total"] += square_errors[is_scored].sum()
+            sum_square_errors[method]["n"] += int(is_scored.sum())
 
     for method, result in sum_square_errors.items():
         if sum_square_errors[method]["n"] > 0:
@@ -151,39 +230,116 @@ def do_interpolation_scoring(
     return pandas.DataFrame(data=data_dict)
 
 
-def score_algorithm(start_date, end_date, repository_parameters, limit=0, interpolation_name="NONE"):
+# The neighbour stations of a worker process, set once when the worker starts
+_worker_neighbour_station_dicts = None
+_worker_neighbour_station_matrix = None
+_worker_distance_matrix = None
+
+
+def _initialise_worker(neighbour_station_dicts, neighbour_station_matrix, distance_matrix):
+    """
+    Hands the neighbour stations to the worker once instead of with every target. When the processes are forked the
+    station dicts are not even copied but shared read-only.
+
+    :param neighbour_station_dicts: The neighbour stations
+    :param neighbour_station_matrix: The upsampled temperatures of the neighbour stations
+    :param distance_matrix: The distances between all stations
+    """
+    global _worker_neighbour_station_dicts, _worker_neighbour_station_matrix, _worker_distance_matrix
+    _worker_neighbour_station_dicts = neighbour_station_dicts
+    _worker_neighbour_station_matrix = neighbour_station_matrix
+    _worker_distance_matrix = distance_matrix
+
+
+def _do_interpolation_scoring_in_worker(target_station_dict, j, target_station_dicts_len, start_date, end_date,
+                                        score_each_minute, seed):
+    return do_interpolation_scoring(target_station_dict, j, target_station_dicts_len,
+                                    _worker_neighbour_station_dicts, start_date, end_date, score_each_minute,
+                                    _worker_neighbour_station_matrix, _worker_distance_matrix, seed)
+
+
+def score_algorithm(start_date, end_date, repository_parameters, limit=0, interpolation_name="NONE",
+                    score_each_minute=False, processes=1, memory_map_dir=None, seed=None):
+    """
+
+    :param start_date: The first day to score
+    :param end_date: The last day to score (included)
+    :param repository_parameters: The station list and summary directory to load the stations from
+    :param limit: Limit to k stations to load
+    :param interpolation_name: Used for the names of the log and the result file
+    :param score_each_minute: Score every minute instead of a random minute per hour
+    :param processes: The number of worker processes scoring the targets in parallel, 1 scores them sequentially
+        in this process and None uses one worker per cpu
+    :param memory_map_dir: If provided, the upsampled neighbour temperatures are kept in a memory map in that
+        directory which is reused by later runs with the same stations and time span
+    :param seed: Makes the separation into targets and neighbours and the scored minutes reproducible, a random seed
+        is chosen (and logged) if None
+    """
+    if seed is None:
+        seed = random.randrange(2 ** 31)
     station_repository = StationRepository(*repository_parameters)
-    station_dicts = station_repository.load_all_stations(start_date, end_date, limit=limit)
+    # the data frames are read in the background and only when they are needed, stations without data get an empty
+    # data frame: as neighbours they never report and as targets they are skipped
+    station_dicts = station_repository.load_all_stations_lazily(start_date, end_date, limit=limit,
+                                                                prefetch_threads=PREFETCH_THREADS)
 
     # separate in two sets
-    random.shuffle(station_dicts)
+    random.Random(seed).shuffle(station_dicts)
     separator = int(.3 * len(station_dicts))  # 70% vs 30%
     target_station_dicts, neighbour_station_dicts = station_dicts[:separator], station_dicts[separator:]
+    # the memory map stores the stations sorted by name
+    neighbour_station_dicts.sort(key=lambda station_dict: station_dict["name"])
 
     setup_logging(interpolation_name)
     logging.info("General Overview")
+    logging.info("seed: " + str(seed))
     logging.info("targets: " + " ".join([station_dict["name"] for station_dict in target_station_dicts]))
     logging.info("neighbours: " + " ".join([station_dict["name"] for station_dict in neighbour_station_dicts]))
     logging.info("End overview")
 
     logging.info("Several Runs")
     target_station_dicts_len = str(len(target_station_dicts))
-
-    overall_result = itertools.starmap(do_interpolation_scoring, [
-        [
-            target_station_dict,
-            j,
-            target_station_dicts_len,
-            neighbour_station_dicts,
-            start_date,
-            end_date
-        ] for j, target_station_dict in enumerate(target_station_dicts)
-    ])
+    neighbour_station_matrix = AbstractNeighbourFinder().sample_up_matrix(
+        neighbour_station_dicts, start_date, end_date, memory_map_dir, station_repository.summary_dir
+    )
+    distance_matrix = station_repository.get_distance_matrix()
+
+    if processes == 1:
+        overall_result = itertools.starmap(do_interpolation_scoring, [
+            [
+                target_station_dict,
+                j,
+                target_station_dicts_len,
+                neighbour_station_dicts,
+                start_date,
+                end_date,
+                score_each_minute,
+                neighbour_station_matrix,
+                distance_matrix,
+                seed + j
+            ] for j, target_station_dict in enumerate(target_station_dicts)
+        ])
+    else:
+        initial_arguments = (neighbour_station_dicts, neighbour_station_matrix, distance_matrix)
+        with multiprocessing.Pool(processes, _initialise_worker, initial_arguments) as pool:
+            # starmap keeps the order of the targets, so the merged result does not depend on the scheduling
+            overall_result = pool.starmap(_do_interpolation_scoring_in_worker, [
+                [
+                    target_station_dict,
+                    j,
+                    target_station_dicts_len,
+                    start_date,
+                    end_date,
+                    score_each_minute,
+                    seed + j
+                ] for j, target_station_dict in enumerate(target_station_dicts)
+            ], chunksize=1)
 
     logging.info("end targets")
 
     logging.info("overall results")
-    overall_result_df = pandas.concat(overall_result)
+    overall_result_df = pandas.concat(overall_result)  # the sequential scoring only runs here
+    station_repository.stop_prefetching()
     column_names = overall_result_df.columns.values.tolist()
     methods = set()
     for column_name in column_names:
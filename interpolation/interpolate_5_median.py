@@ -7,7 +7,6 @@ import datetime
 import random
 import logging
 import itertools
-import statistics
 import sys
 import os
 
@@ -25,12 +24,35 @@ from interpolation.interpolator.statistical_interpolator import get_interpolatio
 pandas.set_option("display.max_rows", 5)
 
 
+def get_median_smoothed_finder(neighbour_station_dicts, start_date, end_date, median_size):
+    """
+    The median of the nearest neighbours of each neighbour only depends on which stations are available, so it is
+    computed once for all time points and shared by all scorers with the same neighbours and time span.
+
+    :param neighbour_station_dicts: The neighbour stations
+    :param start_date: earliest date (included)
+    :param end_date: latest date (included)
+    :param median_size: Each neighbour reports the median of that many nearest available stations
+    :return: A finder which returns the medians instead of the temperatures
+    :rtype: NearestKFinder
+    """
+    key = (tuple(station_dict["name"] for station_dict in neighbour_station_dicts), str(start_date), str(end_date),
+           median_size)
+    if not hasattr(get_median_smoothed_finder, "cache") or get_median_smoothed_finder.cache[0] != key:
+        nearest_k_finder = NearestKFinder(neighbour_station_dicts, start_date, end_date)
+        median_smoothed_matrix = nearest_k_finder.get_median_smoothed_matrix(median_size)
+        median_smoothed_finder = NearestKFinder(neighbour_station_dicts, start_date, end_date,
+                                                station_matrix=median_smoothed_matrix)
+        get_median_smoothed_finder.cache = key, median_smoothed_finder  # only keep the latest one
+    return get_median_smoothed_finder.cache[1]
+
+
 class Scorer:
     def __init__(self, target_station_dict, neighbour_station_dicts, start_date, end_date, median_size=5):
         self.target_station_dict = target_station_dict
-        self.nearest_k_finder = NearestKFinder(neighbour_station_dicts, start_date, end_date)
-        self.key = "interpolation_distance_" + self.target_station_dict["name"]
         self.median_size = median_size
+        self.nearest_k_finder = get_median_smoothed_finder(neighbour_station_dicts, start_date, end_date,
+                                                           median_size)  # <- hence the name of the script
 
     def score_3_nearest_neighbours(self, date, t_actual):
         relevant_neighbours = self.find_k_median_neighbours(date, 3)
@@ -45,19 +67,8 @@ class Scorer:
         return get_interpolation_results(relevant_neighbours, t_actual, "_all")
 
     def find_k_median_neighbours(self, date, k):
-        neighbour_dicts = self.nearest_k_finder.find_k_nearest_neighbour_dicts(
-            self.target_station_dict, date, k
-        )
-        for neighbour_dict in neighbour_dicts:
-            temperatures_and_distances = self.nearest_k_finder.find_k_nearest_neighbours(
-                neighbour_dict, date, self.median_size,  # <- hence the name of the script
-                cache=False
-            )
-            temperatures, distances = zip(*temperatures_and_distances)
-            neighbour_dict["_median"] = statistics.median(temperatures)
-        relevant_neighbours = [(neighbour_dict["_median"], neighbour_dict[self.key])
-                               for neighbour_dict in neighbour_dicts]
-        return relevant_neighbours
+        # the finder works on the precomputed medians, so it directly returns medians and distances
+        return self.nearest_k_finder.find_k_nearest_neighbours(self.target_station_dict, date, k)
 
 
 def score_interpolation_algorithm_at_date(scorer, date):
@@ -1,11 +1,22 @@
 """
 
 """
+import os
+import hashlib
+import logging
 import datetime
 
+import numpy
 import pandas
 import dateutil.parser
 
+from filter_weather_data.filters import StationMatrix
+from filter_weather_data.filters import StationRepository
+from filter_weather_data.filters import SummaryFileIndex
+
+# the number of upsampled grids kept in a memory map directory
+MAX_MEMORY_MAPS = 8
+
 
 class AbstractNeighbourFinder:
 
@@ -31,3 +42,96 @@ class AbstractNeighbourFinder:
         df.temperature.fillna(method="ffill", limit=self.DECAY, inplace=True)
         station_dict["data_frame"] = df
         station_dict["is_sampled_up"] = True
+
+    def sample_up_matrix(self, station_dicts, start_date, end_date, memory_map_dir=None, summary_dir=None):
+        """
+        Works like ``sample_up`` but writes all stations into one minute grid instead of one data frame per station.
+        The station dicts themselves are not modified.
+
+        :param station_dicts: The station dicts to sample up
+        :param start_date: earliest date (included) for upsampling
+        :param end_date: latest date (included) for upsampling
+        :param memory_map_dir: If provided, the grid is stored there once per set of stations and time span and
+            later calls (also from other processes) get a read-only memory map of the same file. The stations are
+            stored sorted by name, so pass them in that order to avoid a copy.
+        :param summary_dir: Where the station summaries have been loaded from, a grid is only reused as long as the
+            summary files of its stations are unchanged
+        :return: The upsampled temperatures
+        :rtype: StationMatrix
+        """
+        if isinstance(end_date, str):
+            end_date = dateutil.parser.parse(end_date)
+        real_end_date = end_date + datetime.timedelta(days=1)
+        index = pandas.date_range(start_date, real_end_date, freq='T', name="datetime")
+        if memory_map_dir is None:
+            not_sampled_up_columns = [j for j, station_dict in enumerate(station_dicts)
+                                      if not station_dict.get("is_sampled_up", False)]
+            station_matrix = StationMatrix.from_station_dicts(station_dicts, index)
+            station_matrix.forward_fill(self.DECAY, not_sampled_up_columns)
+            return station_matrix
+
+        station_names = [station_dict["name"] for station_dict in station_dicts]
+        order = sorted(range(len(station_dicts)), key=lambda j: station_names[j])
+        sorted_station_dicts = [station_dicts[j] for j in order]
+        file_name_prefix = os.path.join(
+            memory_map_dir,
+            "sampled_up_" + self._get_memory_map_key(sorted_station_dicts, index, summary_dir)
+        )
+        station_matrix = StationMatrix.load(file_name_prefix)
+        if station_matrix is not None:
+            logging.debug("reuse memory map " + file_name_prefix)
+            os.utime(file_name_prefix + ".npz")  # mark as recently used
+        else:
+            os.makedirs(memory_map_dir, exist_ok=True)
+            values = numpy.lib.format.open_memmap(
+                file_name_prefix + "." + str(os.getpid()) + ".tmp.npy",
+                mode="w+",
+                dtype=numpy.float32,
+                shape=(len(index), len(sorted_station_dicts))
+            )
+            station_matrix = StationMatrix.from_station_dicts(sorted_station_dicts, index, values)
+            station_matrix.forward_fill(self.DECAY, [j for j, station_dict in enumerate(sorted_station_dicts)
+                                                     if not station_dict.get("is_sampled_up", False)])
+            station_matrix.save(file_name_prefix)
+            logging.debug("created memory map " + file_name_prefix)
+            self._remove_old_memory_maps(memory_map_dir)
+            station_matrix = StationMatrix.load(file_name_prefix)
+        if order != sorted(order):
+            logging.debug("copy memory map to restore the order of the station dicts")
+            station_matrix = StationMatrix(station_matrix.index, station_names,
+                                           station_matrix.values[:, numpy.argsort(order)],
+                                           station_matrix.positions[numpy.argsort(order)])
+        return station_matrix
+
+    def _get_memory_map_key(self, sorted_station_dicts, index, summary_dir):
+        """
+        Identifies a grid by its stations, the modification times of their summary files, the time span and the
+        upsampling.
+        """
+        if summary_dir is None:
+            summary_dir = StationRepository.summary_dir
+        summary_file_index = SummaryFileIndex.for_directory(summary_dir)
+        key_parts = [os.path.realpath(summary_dir), str(index[0]), str(index[-1]), str(self.DECAY)]
+        for station_dict in sorted_station_dicts:
+            key_parts.append(station_dict["name"])
+            key_parts.append(str(station_dict.get("is_sampled_up", False)))
+            for file_name in summary_file_index.get_file_names(station_dict["name"]):
+                key_parts.append(file_name + "@" + str(os.path.getmtime(os.path.join(summary_dir, file_name))))
+        return hashlib.md5("|".join(key_parts).encode()).hexdigest()
+
+    @staticmethod
+    def _remove_old_memory_maps(memory_map_dir):
+        """
+        Keeps the MAX_MEMORY_MAPS most recently used grids, each grid takes several hundred MB per year.
+        """
+        axes_files = [os.path.join(memory_map_dir, file_name) for file_name in os.listdir(memory_map_dir)
+                      if file_name.startswith("sampled_up_") and file_name.endswith(".npz")
+                      and ".tmp." not in file_name]
+        axes_files.sort(key=os.path.getmtime, reverse=True)
+        for axes_file in axes_files[MAX_MEMORY_MAPS:]:
+            logging.debug("remove old memory map " + axes_file[:-4])
+            for file_name in (axes_file, axes_file[:-4] + ".npy"):  # axes first, so the grid is never found half
+                try:
+                    os.remove(file_name)
+                except FileNotFoundError:
+                    pass  # removed by another process
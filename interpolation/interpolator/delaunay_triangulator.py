@@ -2,32 +2,48 @@
 
 """
 import logging
+import collections
 
 import numpy
+import pandas
 from scipy.spatial import Delaunay
-import geopy.distance
 
+from filter_weather_data.filters import get_haversine_distances
 from .abstract_neighbour_finder import AbstractNeighbourFinder
 from ..visualise_points_on_map import draw_map
 
 
 class DelaunayTriangulator(AbstractNeighbourFinder):
 
-    def __init__(self, station_dicts, start_date, end_date, use_triangulation_cache=True):
+    def __init__(self, station_dicts, start_date, end_date, use_triangulation_cache=True, station_matrix=None,
+                 triangulation_cache_size=1024, distance_matrix=None):
+        """
+
+        :param station_dicts: The neighbour stations
+        :param start_date: earliest date (included)
+        :param end_date: latest date (included)
+        :param use_triangulation_cache: Reuse the triangulation if the same stations are available
+        :param station_matrix: The upsampled temperatures of the station dicts in the same order, e.g. shared between
+            several finders, see ``AbstractNeighbourFinder.sample_up_matrix``
+        :param triangulation_cache_size: The number of triangulations to keep, the least recently used ones are
+            dropped first
+        :param distance_matrix: The precomputed distances, see ``StationRepository.get_distance_matrix``
+        """
         self.station_dicts = station_dicts
 
         self.use_triangulation_cache = use_triangulation_cache
-        self.cached_triangulations = {}
+        self.triangulation_cache_size = triangulation_cache_size
+        self.cached_triangulations = collections.OrderedDict()
+        self.distance_matrix = distance_matrix
         self.cached_distances = {}
+        self.last_availability = None
+        self.last_triangulation = None
 
-        # logging.debug("start resampling for delaunay")
-        self.station_dict_at_position = {}
-        for station_dict in station_dicts:
-            position = station_dict["meta_data"]["position"]
-            self.station_dict_at_position[(position["lat"], position["lon"])] = station_dict
-            self.sample_up(station_dict, start_date, end_date)
-
-        # logging.debug("end resampling for delaunay")
+        if station_matrix is None:
+            station_matrix = self.sample_up_matrix(station_dicts, start_date, end_date)
+        elif station_matrix.station_names.tolist() != [station_dict["name"] for station_dict in station_dicts]:
+            raise RuntimeError("The station matrix must contain the station dicts in the same order")
+        self.station_matrix = station_matrix
 
     def find_delaunay_neighbours(self, target_station_dict, t):
         """
@@ -37,69 +53,128 @@ class DelaunayTriangulator(AbstractNeighbourFinder):
         :return: 
         """
 
-        # get delaunay triangulation
-        triangulated = self._get_triangulation(t)
-        if not triangulated:  # not enough data for time point
-            return []
-
-        # search for the index of the triangle the searched coordinates are in
-        position = target_station_dict["meta_data"]["position"]
-        lat, lon = position["lat"], position["lon"]
-        index = triangulated.find_simplex(numpy.array([lat, lon]))
-
-        # outside the triangulated area
-        if index == -1:
+        columns, _ = self.find_delaunay_neighbour_indices([target_station_dict], t)
+        if columns[0, 0] == -1:  # not enough data for time point or outside the triangulated area
             return []
 
-        # find the three triangulation stations
-        delaunay_neighbour_dicts = self._retrieve_station_dicts_from_simplex_index(triangulated, index)
-
         # prepare response
+        temperatures_at_time_t = self.station_matrix.at(t)
         neighbour_values = []
-        for neighbour_dict in delaunay_neighbour_dicts:
-            temperature = neighbour_dict["data_frame"].loc[t].temperature  # this is != NaN
+        for column in columns[0]:
+            neighbour_dict = self.station_dicts[column]
+            temperature = float(temperatures_at_time_t[column])  # this is != NaN
             distance = self._get_distance(target_station_dict, neighbour_dict)
             neighbour_values.append((temperature, distance))
         return neighbour_values
 
+    def find_delaunay_neighbour_indices(self, target_station_dicts, t):
+        """
+        Locates all targets in the triangulation of the time point at once.
+
+        :param target_station_dicts: The stations to find the neighbours for
+        :param t: The time point to check, NaN neighbours don't count
+        :return: Two arrays of shape (len(target_station_dicts), 3), the positions of the neighbour stations in the
+            station dicts (-1 if the target is outside of the triangulated area) and the barycentric weights of the
+            neighbours (NaN if outside)
+        """
+        columns = numpy.full((len(target_station_dicts), 3), -1, dtype=numpy.int64)
+        weights = numpy.full((len(target_station_dicts), 3), numpy.nan)
+
+        # get delaunay triangulation
+        triangulated, available_columns = self._get_triangulation(t)
+        if not triangulated:  # not enough data for time point
+            return columns, weights
+
+        # search for the indices of the triangles the searched coordinates are in
+        positions = [target_station_dict["meta_data"]["position"] for target_station_dict in target_station_dicts]
+        points = numpy.array([(position["lat"], position["lon"]) for position in positions], dtype=numpy.float64)
+        simplex_indices = triangulated.find_simplex(points)
+        inside = simplex_indices != -1
+
+        # find the three triangulation stations
+        columns[inside] = available_columns[triangulated.simplices[simplex_indices[inside]]]
+
+        # the affine transformation of each triangle maps a point to its first two barycentric coordinates
+        transform = triangulated.transform[simplex_indices[inside]]
+        barycentric = numpy.einsum("ijk,ik->ij", transform[:, :2, :], points[inside] - transform[:, 2, :])
+        weights[inside] = numpy.column_stack((barycentric, 1 - barycentric.sum(axis=1)))
+        return columns, weights
+
+    def interpolate_linearly(self, target_station_dicts, t):
+        """
+        Linear interpolation inside the triangle of the delaunay neighbours.
+
+        :param target_station_dicts: The stations to interpolate the temperature for
+        :param t: The time point
+        :return: The interpolated temperatures, NaN for targets outside of the triangulated area
+        :rtype: ``numpy.ndarray``
+        """
+        columns, weights = self.find_delaunay_neighbour_indices(target_station_dicts, t)
+        inside = columns[:, 0] != -1
+        temperatures = numpy.full(len(target_station_dicts), numpy.nan)
+        temperatures[inside] = (self.station_matrix.at(t)[columns[inside]] * weights[inside]).sum(axis=1)
+        return temperatures
+
+    def find_delaunay_neighbours_for_dates(self, target_station_dict, dates):
+        """
+        Batched version of ``find_delaunay_neighbours`` for many time points. The target is located only once per
+        set of available stations.
+
+        :param target_station_dict: The station to find the neighbours for
+        :param dates: The time points to check, NaN neighbours don't count
+        :return: Two arrays of shape (len(dates), 3), the temperatures and the distances, NaN where the target is
+            not inside the triangulation
+        """
+        temperatures = numpy.full((len(dates), 3), numpy.nan)
+        distances = numpy.full((len(dates), 3), numpy.nan)
+        if len(dates) == 0:
+            return temperatures, distances
+        dates = pandas.DatetimeIndex(dates)
+        rows = self.station_matrix.index.get_indexer(dates)
+        if (rows == -1).any():
+            raise KeyError(dates[rows == -1][0])
+
+        # all time points with the same available stations share the triangulation and thus the triangle of the target
+        availabilities = self.station_matrix.get_availability_bitmasks()[rows]
+        _, group_of_date = numpy.unique(availabilities, axis=0, return_inverse=True)
+        group_of_date = group_of_date.ravel()
+        date_positions = numpy.argsort(group_of_date, kind="stable")
+        group_starts = numpy.flatnonzero(numpy.diff(group_of_date[date_positions])) + 1
+        for group in numpy.split(date_positions, group_starts):
+            columns, _ = self.find_delaunay_neighbour_indices([target_station_dict], dates[group[0]])
+            if columns[0, 0] == -1:  # not enough data for time point or outside the triangulated area
+                continue
+            temperatures[group] = self.station_matrix.values[rows[group][:, numpy.newaxis], columns[0]]
+            distances[group] = [self._get_distance(target_station_dict, self.station_dicts[column])
+                                for column in columns[0]]
+        return temperatures, distances
+
     def _get_triangulation(self, t):
         """
         
         :param t: The data point
-        :return: ``scipy.spatial.Delaunay``
+        :return: ``scipy.spatial.Delaunay`` and the positions of its points in the station dicts
         """
-        filtered_stations = []
-        for station_dict in self.station_dicts:
-            temperature_at_time_t = station_dict["data_frame"].loc[t].temperature
-            if not numpy.isnan(temperature_at_time_t):
-                position = station_dict["meta_data"]["position"]
-                filtered_stations.append((position["lat"], position["lon"]))
-        if len(filtered_stations) <= 4:  # QHULL: needs 4 to form initial simplex
-            return []
-        filtered_stations = tuple(filtered_stations)
-        if self.use_triangulation_cache and filtered_stations in self.cached_triangulations:
-            triangulated = self.cached_triangulations[filtered_stations]
+        row = self.station_matrix.get_row_position(t)
+        availability = self.station_matrix.get_availability_bitmasks()[row].tobytes()
+        if availability == self.last_availability:  # mostly the same stations report in consecutive minutes
+            return self.last_triangulation
+        if self.use_triangulation_cache and availability in self.cached_triangulations:
+            self.cached_triangulations.move_to_end(availability)
+            triangulation = self.cached_triangulations[availability]
         else:
-            filtered_stations_array = numpy.array(filtered_stations)
-            triangulated = Delaunay(filtered_stations_array)
+            available_columns = numpy.flatnonzero(~numpy.isnan(self.station_matrix.values[row]))
+            if len(available_columns) <= 4:  # QHULL: needs 4 to form initial simplex
+                triangulation = [], available_columns
+            else:
+                triangulation = Delaunay(self.station_matrix.positions[available_columns]), available_columns
             if self.use_triangulation_cache:
-                self.cached_triangulations[filtered_stations] = triangulated
-        return triangulated
-
-    def _retrieve_station_dicts_from_simplex_index(self, triangulated, index):
-        """
-        
-        :param triangulated: A scipy triangulation
-        :param index: The index for the triangulation
-        :return: The three neighbours.
-        """
-
-        coordinates_index = triangulated.simplices[index]
-        coordinates = triangulated.points[coordinates_index]
-        station_dicts = []
-        for station_coordinates in coordinates:
-            station_dicts.append(self.station_dict_at_position[tuple(station_coordinates)])
-        return station_dicts
+                self.cached_triangulations[availability] = triangulation
+                if len(self.cached_triangulations) > self.triangulation_cache_size:
+                    self.cached_triangulations.popitem(last=False)
+        self.last_availability = availability
+        self.last_triangulation = triangulation
+        return triangulation
 
     def _get_distance(self, station_dict_a, station_dict_b):
         """
@@ -113,12 +188,14 @@ class DelaunayTriangulator(AbstractNeighbourFinder):
         """
         station_a = station_dict_a["name"]
         station_b = station_dict_b["name"]
+        if (self.distance_matrix is not None and station_a in self.distance_matrix.index
+                and station_b in self.distance_matrix.index):
+            return self.distance_matrix.at[station_a, station_b]
         if (station_a, station_b) not in self.cached_distances:
             position_a = station_dict_a["meta_data"]["position"]
             position_b = station_dict_b["meta_data"]["position"]
-            point_a = geopy.Point(position_a["lat"], position_a["lon"])
-            point_b = geopy.Point(position_b["lat"], position_b["lon"])
-            distance = geopy.distance.distance(point_a, point_b).m
+            distance = get_haversine_distances([position_a["lat"]], [position_a["lon"]],
+                                               [position_b["lat"]], [position_b["lon"]])[0, 0]
             self.cached_distances[(station_b, station_a)] = self.cached_distances[(station_a, station_b)] = distance
         return self.cached_distances[(station_b, station_a)]
 
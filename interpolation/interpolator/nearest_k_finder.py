@@ -4,40 +4,120 @@
 import logging
 
 import numpy
-import geopy
-import geopy.distance
+import pandas
+from scipy.spatial import cKDTree
 
+from filter_weather_data.filters import EARTH_RADIUS
+from filter_weather_data.filters import StationMatrix
 from ..visualise_points_on_map import draw_map
 from .abstract_neighbour_finder import AbstractNeighbourFinder
 
 
+def get_unit_vectors(lats, lons):
+    """
+    Project positions onto the unit sphere. The euclidean (chord) distance between two such vectors is monotonic
+    in the great circle distance, so a euclidean spatial index returns the same ordering.
+
+    :param lats: latitudes in degree
+    :param lons: longitudes in degree
+    :return: An array of shape (n, 3)
+    """
+    lats = numpy.radians(numpy.asarray(lats, dtype=numpy.float64))
+    lons = numpy.radians(numpy.asarray(lons, dtype=numpy.float64))
+    return numpy.column_stack((
+        numpy.cos(lats) * numpy.cos(lons),
+        numpy.cos(lats) * numpy.sin(lons),
+        numpy.sin(lats)
+    ))
+
+
+def chord_to_great_circle_distance(chord_distances):
+    """
+
+    :param chord_distances: euclidean distances between unit vectors
+    :return: distances along the earth surface in m
+    """
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.minimum(numpy.asarray(chord_distances) / 2, 1))
+
+
 class NearestKFinder(AbstractNeighbourFinder):
 
-    def __init__(self, station_dicts, start_date, end_date):
-        self._sorted_station_dicts = station_dicts[:]
-        self.last_target = None
-        self.cached_temporary = {}
+    def __init__(self, station_dicts, start_date, end_date, station_matrix=None, distance_matrix=None):
+        """
 
-        # logging.debug("start resampling for k nearest")
-        self.station_dict_at_position = {}
-        for station_dict in station_dicts:
-            self.sample_up(station_dict, start_date, end_date)
-        # logging.debug("end resampling for k nearest")
+        :param station_dicts: The neighbour stations
+        :param start_date: earliest date (included)
+        :param end_date: latest date (included)
+        :param station_matrix: The upsampled temperatures of the station dicts in the same order, e.g. shared between
+            several finders, see ``AbstractNeighbourFinder.sample_up_matrix``
+        :param distance_matrix: The precomputed distances, see ``StationRepository.get_distance_matrix``
+        """
+        self.station_dicts = station_dicts[:]
+        self.distance_matrix = distance_matrix
+        self.cached_sorting = {}
+
+        if station_matrix is None:
+            station_matrix = self.sample_up_matrix(station_dicts, start_date, end_date)
+        elif station_matrix.station_names.tolist() != [station_dict["name"] for station_dict in station_dicts]:
+            raise RuntimeError("The station matrix must contain the station dicts in the same order")
+        self.station_matrix = station_matrix
+        self.tree = cKDTree(get_unit_vectors(self.station_matrix.positions[:, 0],
+                                             self.station_matrix.positions[:, 1]))
+
+    def query_nearest_stations(self, target_dicts, k=-1):
+        """
+        Looks up the nearest stations for many targets at once, regardless of their availability.
+
+        :param target_dicts: The stations to look for
+        :param k: The number of neighbours, all neighbours for k=-1
+        :return: Two arrays of shape (len(target_dicts), k), the station indices and the distances in m
+        """
+        if k == -1 or k > len(self.station_dicts):
+            k = len(self.station_dicts)
+        positions = [target_dict["meta_data"]["position"] for target_dict in target_dicts]
+        search = get_unit_vectors([position["lat"] for position in positions],
+                                  [position["lon"] for position in positions])
+        chord_distances, indices = self.tree.query(search, k=k)
+        chord_distances = numpy.reshape(chord_distances, (len(target_dicts), k))
+        indices = numpy.reshape(indices, (len(target_dicts), k))
+        return indices, chord_to_great_circle_distance(chord_distances)
 
     def _sort_for_target(self, target_dict):
-        position = target_dict["meta_data"]["position"]
-        search_lat = position["lat"]
-        search_lon = position["lon"]
-        search = geopy.Point(search_lat, search_lon)
+        """
+
+        :param target_dict: The station to look for
+        :return: The station indices and their distances, both sorted by distance
+        """
         key = "interpolation_distance_" + target_dict["name"]
-        for station_dict in self._sorted_station_dicts:
-            position = station_dict["meta_data"]["position"]
-            point_lat = position["lat"]
-            point_lon = position["lon"]
-            point = geopy.Point(point_lat, point_lon)
-            distance = geopy.distance.distance(point, search).m
-            station_dict[key] = distance
-        self._sorted_station_dicts.sort(key=lambda station_dict: station_dict[key])
+        if key not in self.cached_sorting:
+            if self.distance_matrix is not None and target_dict["name"] in self.distance_matrix.index:
+                distances = self.distance_matrix.loc[target_dict["name"]].reindex(self.station_matrix.station_names)
+                distances = distances.values
+            else:
+                distances = None
+            if distances is not None and not numpy.isnan(distances).any():
+                indices = numpy.argsort(distances, kind="mergesort")
+                distances = distances[indices]
+            else:
+                indices, distances = self.query_nearest_stations([target_dict])
+                indices, distances = indices[0], distances[0]
+            for i, distance in zip(indices, distances):
+                self.station_dicts[i][key] = distance
+            self.cached_sorting[key] = indices, distances
+        return self.cached_sorting[key]
+
+    def _find_available(self, target_dict, date, k):
+        """
+
+        :return: The indices and distances of the k nearest stations which report at that date
+        """
+        indices, distances = self._sort_for_target(target_dict)
+        row = self.station_matrix.get_row_position(date)
+        available = ~numpy.isnan(self.station_matrix.values[row, indices])
+        indices, distances = indices[available], distances[available]
+        if k != -1:
+            indices, distances = indices[:k], distances[:k]
+        return indices, distances, row
 
     def find_k_nearest_neighbours(self, target_dict, date, k, cache=True):
         """
@@ -45,55 +125,70 @@ class NearestKFinder(AbstractNeighbourFinder):
         :param target_dict: The station to look for
         :param date: The time point (pandas compatible)
         :param k: The number of neighbours, all neighbours for k=-1
+        :param cache: Kept for compatibility, the sorting is always cached per target
         :return: List of closest temperatures and distances
         """
-        if self.last_target != target_dict:
-            self._sort_for_target(target_dict)
+        indices, distances, row = self._find_available(target_dict, date, k)
+        temperatures = self.station_matrix.values[row, indices]
+        return list(zip(temperatures.tolist(), distances.tolist()))
 
-        neighbours = []
-        found = 0
-        key = "interpolation_distance_" + target_dict["name"]
-        if cache:
-            for target_dict in self._sorted_station_dicts:
-                temperature_at_time_t = target_dict["data_frame"].loc[date].temperature
-                if numpy.isnan(temperature_at_time_t):  # station not available
-                    continue
-                else:
-                    found += 1
-                    distance = target_dict[key]
-                    neighbours.append((temperature_at_time_t, distance))
-                    if k != -1 and found == k:
-                        break
-            return neighbours
-        else:
-            distance_key = "interpolation_distance_" + target_dict["name"]
-            if distance_key not in self.cached_temporary:
-                sorted_station_dicts = self._sorted_station_dicts.copy()
-                position = target_dict["meta_data"]["position"]
-                search_lat = position["lat"]
-                search_lon = position["lon"]
-                search = geopy.Point(search_lat, search_lon)
-                for station_dict in sorted_station_dicts:
-                    if distance_key not in station_dict:
-                        position = station_dict["meta_data"]["position"]
-                        point_lat = position["lat"]
-                        point_lon = position["lon"]
-                        point = geopy.Point(point_lat, point_lon)
-                        distance = geopy.distance.distance(point, search).m
-                        station_dict[distance_key] = distance
-                sorted_station_dicts.sort(key=lambda station_dict: station_dict[distance_key])
-                self.cached_temporary[distance_key] = sorted_station_dicts
-            for station_dict in self.cached_temporary[distance_key]:
-                temperature_at_time_t = station_dict["data_frame"].loc[date].temperature
-                if numpy.isnan(temperature_at_time_t):  # station not available
+    def find_k_nearest_neighbours_for_dates(self, target_dict, dates, k):
+        """
+        Batched version of ``find_k_nearest_neighbours`` for many time points.
+
+        :param target_dict: The station to look for
+        :param dates: The time points (pandas compatible)
+        :param k: The number of neighbours, all neighbours for k=-1
+        :return: Two arrays of shape (len(dates), k), the temperatures and the distances, NaN where less than k
+            stations are available
+        """
+        indices, distances = self._sort_for_target(target_dict)
+        if k == -1:
+            k = len(indices)
+        rows = self.station_matrix.index.get_indexer(pandas.DatetimeIndex(dates))
+        if (rows == -1).any():
+            raise KeyError("dates outside of the upsampled time span")
+        sorted_temperatures = self.station_matrix.values[rows[:, numpy.newaxis], indices]
+        available = ~numpy.isnan(sorted_temperatures)
+        # the stable sort moves the available stations to the front and keeps them ordered by distance
+        picked = numpy.argsort(~available, axis=1, kind="mergesort")[:, :k]
+        row_selector = numpy.arange(len(rows))[:, numpy.newaxis]
+        is_picked_available = available[row_selector, picked]
+        temperatures = sorted_temperatures[row_selector, picked].astype(numpy.float64)
+        picked_distances = distances[picked]
+        temperatures[~is_picked_available] = numpy.nan
+        picked_distances[~is_picked_available] = numpy.nan
+        return temperatures, picked_distances
+
+    def get_median_smoothed_matrix(self, k):
+        """
+        Replaces every available temperature with the median of the k nearest available stations at that time
+        point, the station itself included.
+
+        :param k: The number of stations to take the median of
+        :return: The smoothed temperatures, NaN wherever the original station is not available
+        :rtype: StationMatrix
+        """
+        values = self.station_matrix.values
+        smoothed_values = numpy.full(values.shape, numpy.nan, dtype=numpy.float32)
+        sorted_indices, _ = self.query_nearest_stations(self.station_dicts)
+        candidates = min(len(self.station_dicts), 4 * k)  # mostly enough to find k available stations
+        block_size = 2 ** 14
+        for block_start in range(0, len(values), block_size):
+            block_values = numpy.asarray(values[block_start:block_start + block_size])
+            for j in range(len(self.station_dicts)):
+                rows = numpy.flatnonzero(~numpy.isnan(block_values[:, j]))
+                if not len(rows):
                     continue
-                else:
-                    found += 1
-                    distance = station_dict[distance_key]
-                    neighbours.append((temperature_at_time_t, distance))
-                    if k != -1 and found == k:
-                        break
-            return neighbours
+                sorted_temperatures = block_values[rows[:, numpy.newaxis], sorted_indices[j, :candidates]]
+                medians, has_enough = _get_median_of_nearest_available(sorted_temperatures, k)
+                if not has_enough.all() and candidates < len(self.station_dicts):
+                    missing_rows = rows[~has_enough]
+                    sorted_temperatures = block_values[missing_rows[:, numpy.newaxis], sorted_indices[j]]
+                    medians[~has_enough], _ = _get_median_of_nearest_available(sorted_temperatures, k)
+                smoothed_values[block_start + rows, j] = medians
+        return StationMatrix(self.station_matrix.index, self.station_matrix.station_names, smoothed_values,
+                             self.station_matrix.positions)
 
     def find_k_nearest_neighbour_dicts(self, target_dict, date, k):
         """
@@ -101,23 +196,24 @@ class NearestKFinder(AbstractNeighbourFinder):
         :param target_dict: The station to look for
         :param date: The time point (pandas compatible)
         :param k: The number of neighbours, all neighbours for k=-1
-        :return: List of closest temperatures and distances
+        :return: List of closest station dicts
         """
-        if self.last_target != target_dict:
-            self._sort_for_target(target_dict)
-
-        neighbours = []
-        found = 0
-        for station_dict in self._sorted_station_dicts:
-            temperature_at_time_t = station_dict["data_frame"].loc[date].temperature
-            if numpy.isnan(temperature_at_time_t):  # station not available
-                continue
-            else:
-                found += 1
-                neighbours.append(station_dict)
-                if k != -1 and found == k:
-                    break
-        return neighbours
+        indices, _, _ = self._find_available(target_dict, date, k)
+        return [self.station_dicts[i] for i in indices]
+
+
+def _get_median_of_nearest_available(sorted_temperatures, k):
+    """
+
+    :param sorted_temperatures: The temperatures sorted by distance with shape (n, number of stations), NaN for
+        unavailable stations
+    :param k: The number of available stations to take the median of
+    :return: The medians and whether k stations were available
+    """
+    available = ~numpy.isnan(sorted_temperatures)
+    is_picked = available & (numpy.cumsum(available, axis=1) <= k)
+    medians = numpy.nanmedian(numpy.where(is_picked, sorted_temperatures, numpy.nan), axis=1)
+    return medians, available.sum(axis=1) >= k
 
 
 def demo():
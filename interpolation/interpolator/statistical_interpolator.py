@@ -3,9 +3,10 @@
 Run demo with
 python3 -m interpolation.interpolator.statistical_interpolator interpolator/statistical_interpolator.py
 """
-import statistics
 import logging
 
+import numpy
+
 
 def inverted_distance_weight(temperatures, distances, p):
     """
@@ -45,19 +46,59 @@ def get_interpolation_results(temperature_distance_tuples, t_actual, postfix="")
     if not temperature_distance_tuples:  # No neighbours could be found
         return {}
     temperatures, distances = zip(*temperature_distance_tuples)
-    calculate_square_error = get_square_error_calculator(t_actual)
-    result = {
-        "idw_p1" + postfix: calculate_square_error(inverted_distance_weight(temperatures, distances, 1)),
-        "idw_p2" + postfix: calculate_square_error(inverted_distance_weight(temperatures, distances, 2)),
-        "idw_p3" + postfix: calculate_square_error(inverted_distance_weight(temperatures, distances, 3)),
-        "idw_p4" + postfix: calculate_square_error(inverted_distance_weight(temperatures, distances, 4)),
-        "max" + postfix: calculate_square_error(max(temperatures)),
-        "median" + postfix: calculate_square_error(statistics.median(temperatures)),
-        "min" + postfix: calculate_square_error(min(temperatures)),
-        "mean" + postfix: calculate_square_error(statistics.mean(temperatures))
-    }
-
-    return result
+    result = get_interpolation_results_for_dates([temperatures], [distances], [t_actual], postfix)
+    return {method: float(square_errors[0]) for method, square_errors in result.items()}
+
+
+def get_interpolation_estimations_for_dates(temperatures, distances):
+    """
+    Estimates the temperature with several simplistic methods for many time points at once.
+
+    :param temperatures: The neighbour temperatures as an array of shape (n, k), NaN for missing neighbours
+    :param distances: The neighbour distances (in m) as an array of shape (n, k)
+    :return: The estimated temperatures per method as arrays of shape (n,), NaN where no neighbours are available
+    :rtype: dict
+    """
+    temperatures = numpy.asarray(temperatures, dtype=numpy.float64)
+    distances = numpy.asarray(distances, dtype=numpy.float64)
+    available = ~numpy.isnan(temperatures)
+    has_neighbours = available.any(axis=1)
+    temperatures_or_zero = numpy.where(available, temperatures, 0)
+
+    estimations = {}
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        inverted_distances = numpy.where(available, 1 / distances, 0)
+        weights = numpy.ones_like(inverted_distances)
+        for p in (1, 2, 3, 4):
+            weights *= inverted_distances  # the weights for p are the inverted distances to the power of p
+            estimations["idw_p" + str(p)] = (weights * temperatures_or_zero).sum(axis=1) / weights.sum(axis=1)
+        estimations["max"] = numpy.fmax.reduce(temperatures, axis=1)
+        estimations["min"] = numpy.fmin.reduce(temperatures, axis=1)
+        estimations["mean"] = temperatures_or_zero.sum(axis=1) / available.sum(axis=1)
+    median = numpy.full(len(temperatures), numpy.nan)
+    if has_neighbours.any():
+        median[has_neighbours] = numpy.nanmedian(temperatures[has_neighbours], axis=1)
+    estimations["median"] = median
+
+    for estimation in estimations.values():
+        estimation[~has_neighbours] = numpy.nan
+    return estimations
+
+
+def get_interpolation_results_for_dates(temperatures, distances, t_actual, postfix=""):
+    """
+    Works like ``get_interpolation_results`` but for many time points at once.
+
+    :param temperatures: The neighbour temperatures as an array of shape (n, k), NaN for missing neighbours
+    :param distances: The neighbour distances (in m) as an array of shape (n, k)
+    :param t_actual: The actual temperatures as an array of shape (n,)
+    :param postfix: The postfix for different methods if needed
+    :return: The square errors of several simplistic measurements, NaN where no neighbours could be found
+    :rtype: dict
+    """
+    t_actual = numpy.asarray(t_actual, dtype=numpy.float64)
+    estimations = get_interpolation_estimations_for_dates(temperatures, distances)
+    return {method + postfix: (estimation - t_actual) ** 2 for method, estimation in estimations.items()}
 
 
 def demo():